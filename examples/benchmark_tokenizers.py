@@ -0,0 +1,67 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Compares the speed of the dictionary tokenizers (see --dict-tokenizer) on
+a sample of the examples of the tasks specified.
+
+For example, to compare them on 10k examples from bAbI and the Cornell movie
+dialogs:
+`python examples/benchmark_tokenizers.py -t babi:task10k:1,cornell_movie -n 10000`
+"""
+
+from parlai.core.agents import Agent
+from parlai.core.dict import DictionaryAgent
+from parlai.core.params import ParlaiParser
+from parlai.core.worlds import create_task
+
+import time
+
+
+class TextCollector(Agent):
+    """Keeps the text and labels of the examples it observes."""
+
+    def __init__(self, opt):
+        super().__init__(opt)
+        self.texts = []
+
+    def act(self):
+        obs = self.observation
+        if obs.get('text'):
+            self.texts.append(obs['text'])
+        self.texts.extend(obs.get('labels') or [])
+        return {}
+
+
+def main():
+    # Get command line arguments
+    parser = ParlaiParser()
+    DictionaryAgent.add_cmdline_args(parser)
+    parser.add_argument('-n', '--num-examples', default=10000, type=int)
+    opt = parser.parse_args()
+    opt['datatype'] = 'train:ordered'
+    opt['numthreads'] = 1
+    opt['batchsize'] = 1
+
+    collector = TextCollector(opt)
+    world = create_task(opt, collector)
+    for _ in range(opt['num_examples']):
+        world.parley()
+        if world.epoch_done():
+            break
+    texts = collector.texts
+    print('[ sampled {} texts ]'.format(len(texts)))
+
+    for tokenizer in ['punkt', 'regex', 'split']:
+        opt['dict_tokenizer'] = tokenizer
+        dictionary = DictionaryAgent(opt)
+        start = time.time()
+        num_tokens = sum(len(list(dictionary.tokenize(text)))
+                         for text in texts)
+        elapsed = time.time() - start
+        print('[ {}: {} tokens in {:.2f}s, {:.0f} tokens/sec ]'.format(
+              tokenizer, num_tokens, elapsed, num_tokens / max(elapsed, 1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,8 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 """Generates a dictionary file from the training data."""
 
-from parlai.core.dict import DictionaryAgent
-from parlai.core.worlds import DialogPartnerWorld
+from parlai.core.dict import DictionaryAgent, build_dict_parallel
 from parlai.core.params import ParlaiParser
-from parlai.core.worlds import create_task
 
 def main():
     # Get command line arguments
@@ -18,14 +16,10 @@ def main():
 
     dictionary = DictionaryAgent(opt)
 
-    for datatype in ['train:ordered', 'valid']:
-        # we use train and valid sets to build dictionary
-        opt['datatype'] = datatype
-        world = create_task(opt, dictionary)
-
-        # pass examples to dictionary
-        for _ in range(len(world)):
-            world.parley()
+    # we use train and valid sets to build dictionary, with one process per
+    # thread
+    build_dict_parallel(dictionary, opt, ['train:ordered', 'valid'],
+                        opt['numthreads'])
 
     if 'dict_savepath' in opt:
         dictionary.save(opt['dict_savepath'])
@@ -27,22 +27,18 @@ import sys
 from parlai.agents.drqa.agents import SimpleDictionaryAgent
 from parlai.agents.drqa.agents import DocReaderAgent
 from parlai.agents.drqa.utils import Timer
+from parlai.core.dict import build_dict_parallel
 from parlai.core.worlds import DialogPartnerWorld
 from parlai.core.params import ParlaiParser
 from parlai.core.worlds import create_task
 
 
 def build_dict(opt):
-    opt = copy.deepcopy(opt)
-    opt['batchsize'] = 1
     dictionary = SimpleDictionaryAgent(opt)
 
     # We use the train set to build the dictionary.
     logger.info('[ Building dictionary... ]')
-    opt['datatype'] = 'train:ordered'
-    world = create_task(opt, dictionary)
-    for _ in world:
-        world.parley()
+    build_dict_parallel(dictionary, opt, ['train:ordered'], opt['numthreads'])
 
     dictionary.sort()
     logger.info('[ Dictionary built. ]')
@@ -54,15 +50,15 @@ def build_dict(opt):
 def validate(opt, agent, n_iter):
     opt = copy.deepcopy(opt)
     opt['datatype'] = 'valid'
-    opt['batchsize'] = 1
-    valid_world = create_task(opt, agent)
 
     logger.info('[ Running validation... ]')
     valid_time = Timer()
-    for _ in valid_world:
-        valid_world.parley()
+    # shutting the world down stops the processes of --parallel-eval
+    with create_task(opt, agent) as valid_world:
+        for _ in valid_world:
+            valid_world.parley()
+        metrics = valid_world.report()
 
-    metrics = valid_world.report()
     logger.info('[valid] iter = %d | EM = %.2f | F1 = %.2f | exs = %d' %
                 (n_iter, metrics['accuracy'], metrics['f1'], metrics['total']))
     logger.info('[ Done. Time = %.2f (s) ]' % valid_time.time())
@@ -101,6 +97,8 @@ def main(opt):
         train_time.reset()
         for _ in range(opt['train_interval']):
             train_world.parley()
+        # wait for hogwild processes to finish the queued examples
+        train_world.synchronize()
         logger.info('[ Done. Time = %.2f (s) ]' % train_time.time())
 
         # ...validate!
@@ -119,6 +117,8 @@ def main(opt):
 
         iteration += 1
 
+    train_world.shutdown()
+
 
 if __name__ == '__main__':
     # Get command line arguments
@@ -154,6 +154,14 @@ if __name__ == '__main__':
         logger.info('[ Using CUDA (GPU %d) ]' % opt['gpu'])
         torch.cuda.set_device(opt['gpu'])
 
+    # Hogwild training: processes share the parameters in CPU memory, and
+    # each uses a single core
+    if opt['numthreads'] > 1:
+        if opt['cuda']:
+            raise RuntimeError('Hogwild training (numthreads > 1) is only ' +
+                               'supported on CPU. Use --no_cuda.')
+        torch.set_num_threads(1)
+
     # Set random state
     np.random.seed(opt['random_seed'])
     torch.manual_seed(opt['random_seed'])
@@ -8,12 +8,20 @@ import numpy as np
 import logging
 import regex
 import copy
+import os
+import threading
 
-from parlai.core.agents import Agent
+from collections import OrderedDict
+
+from parlai.core.agents import Agent, create_agent_from_shared
 from parlai.core.dict import DictionaryAgent
+from parlai.core.thread_utils import SharedCounters
 from . import config
 from .utils import build_feature_dict, vectorize, batchify, normalize_text
+from .utils import padding_ratio, AverageMeter, vectorize_document, Timer
+from .utils import load_embedding_index
 from .model import DocReaderModel
+from .pipeline import TrainPipeline
 
 logger = logging.getLogger('DrQA')
 
@@ -49,8 +57,8 @@ class SimpleDictionaryAgent(DictionaryAgent):
             help='Use only words found in provided embedding_file'
         )
 
-    def __init__(self, *args, **kwargs):
-        super(SimpleDictionaryAgent, self).__init__(*args, **kwargs)
+    def __init__(self, opt, shared=None):
+        super(SimpleDictionaryAgent, self).__init__(opt, shared)
 
         # Compile tokenizing regex
         self._regexp = regex.compile(
@@ -59,21 +67,22 @@ class SimpleDictionaryAgent(DictionaryAgent):
         )
 
         # Index words in embedding file
-        if self.opt['pretrained_words'] and 'embedding_file' in self.opt:
+        if shared:
+            self.embedding_words = shared['embedding_words']
+        elif self.opt['pretrained_words'] and 'embedding_file' in self.opt:
             logger.info('[ Indexing words with embeddings... ]')
-            self.embedding_words = set()
-            with open(self.opt['embedding_file']) as f:
-                for line in f:
-                    w = normalize_text(line.rstrip().split(' ')[0])
-                    self.embedding_words.add(w)
+            words, _ = load_embedding_index(self.opt['embedding_file'])
+            self.embedding_words = set(words)
             logger.info('[ Num words in set = %d ]' %
                         len(self.embedding_words))
         else:
             self.embedding_words = None
 
+    def _split_words(self, text, building=False):
+        return (tuple(self._regexp.findall(normalize_text(text))),)
+
     def tokenize(self, text, **kwargs):
-        text = normalize_text(text)
-        return self._regexp.findall(text)
+        return list(self._cached_split_words(text)[0])
 
     def span_tokenize(self, text):
         text = normalize_text(text)
@@ -83,15 +92,14 @@ class SimpleDictionaryAgent(DictionaryAgent):
         """Builds dictionary from the list of provided tokens.
         Only adds words contained in self.embedding_words, if not None.
         """
-        for token in tokens:
-            if (self.embedding_words is not None and
-                token not in self.embedding_words):
-                continue
-            self.freq[token] += 1
-            if token not in self.tok2ind:
-                index = len(self.tok2ind)
-                self.tok2ind[token] = index
-                self.ind2tok[index] = token
+        if self.embedding_words is not None:
+            tokens = [t for t in tokens if t in self.embedding_words]
+        super().add_to_dict(tokens)
+
+    def share(self):
+        shared = super().share()
+        shared['embedding_words'] = self.embedding_words
+        return shared
 
 
 # ------------------------------------------------------------------------------
@@ -108,15 +116,23 @@ class DocReaderAgent(Agent):
     def __init__(self, opt, shared=None, word_dict=None):
         # All agents keep track of the episode (for multiple questions)
         self.episode_done = True
+        self.id = self.__class__.__name__
 
-        # Only create an empty dummy class when sharing
+        # Shared agents use the same network (with parameters in shared memory
+        # on CPU, see share()) and dicts as the original agent, and can train
+        # it Hogwild-style with their own optimizer
         if shared is not None:
             self.is_shared = True
+            self.opt = shared['opt']
+            self.dict = shared['word_dict']
+            self.feature_dict = shared['feature_dict']
+            self.model = shared['model'].shared_copy()
+            self.counters = shared['counters']
+            self._init_pipeline()
             return
 
         # Set up params/logging/dicts
         self.is_shared = False
-        self.id = self.__class__.__name__
         self.opt = copy.deepcopy(opt)
         config.set_defaults(self.opt)
 
@@ -139,7 +155,28 @@ class DocReaderAgent(Agent):
         # Intialize model
         logger.info('[ Initializing DocReaderModel ]')
         self.model = DocReaderModel(self.opt, self.dict, self.state_dict)
+        self._init_pipeline()
+
+    def _init_pipeline(self):
+        """Set up the state used to turn observations into batches."""
         self.n_examples = 0
+        self.train_time = Timer()
+
+        self.padding = AverageMeter()
+
+        # Tokenized and vectorized documents, most recently used last
+        self.doc_cache = OrderedDict()
+        self.doc_cache_lock = threading.Lock()
+
+        # Training batches built in the background (prefetch_workers > 0) and
+        # bucketed by document length (bucket_pool > 0)
+        self.pipeline = TrainPipeline(
+            self._build_train_batch, self._update, self.opt['batchsize'],
+            bucket_pool=self.opt['bucket_pool'],
+            workers=self.opt['prefetch_workers'],
+            depth=self.opt['prefetch_depth'],
+            length=lambda ex: ex[0].size(0),
+        )
 
     def observe(self, observation):
         observation = copy.deepcopy(observation)
@@ -152,23 +189,19 @@ class DocReaderAgent(Agent):
 
     def act(self):
         """Update or predict on a single example (batchsize = 1)."""
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
-
         reply = {'id': self.getID()}
 
+        # Train after the batches already queued, as batch_act does
+        if 'labels' in self.observation:
+            self.pipeline.submit([self.observation])
+            return reply
+
+        self.pipeline.flush()
         ex = self._build_ex(self.observation)
         if ex is None:
             return reply
         batch = batchify([ex], null=self.dict['<NULL>'])
-
-        # Either train or predict
-        if 'labels' in self.observation:
-            self.n_examples += 1
-            self.model.update(batch)
-            self._log()
-        else:
-            reply['text'] = self.model.predict(batch)[0]
+        reply['text'] = self.model.predict(batch)[0]
 
         return reply
 
@@ -176,14 +209,20 @@ class DocReaderAgent(Agent):
         """Update or predict on a batch of examples.
         More efficient than act().
         """
-        if self.is_shared:
-            raise RuntimeError("Parallel act is not supported.")
-
         batchsize = len(observations)
         batch_reply = [{'id': self.getID()} for _ in range(batchsize)]
 
+        # Training replies do not depend on the update, so the batch can be
+        # built in the background and the update done later.
+        if any('labels' in obs for obs in observations):
+            self.pipeline.submit(observations)
+            return batch_reply
+
+        # Predictions must see every update queued or pooled so far.
+        self.pipeline.flush()
+
         # Some examples will be None (no answer found). Filter them.
-        examples = [self._build_ex(obs) for obs in observations]
+        examples = self.pipeline.map(self._build_ex, observations)
         valid_inds = [i for i in range(batchsize) if examples[i] is not None]
         examples = [ex for ex in examples if ex is not None]
 
@@ -193,26 +232,46 @@ class DocReaderAgent(Agent):
 
         # Else, use what we have (hopefully everything).
         batch = batchify(examples, null=self.dict['<NULL>'])
-
-        # Either train or predict
-        if 'labels' in observations[0]:
-            self.n_examples += len(examples)
-            self.model.update(batch)
-            self._log()
-        else:
-            predictions = self.model.predict(batch)
-            for i in range(len(predictions)):
-                batch_reply[valid_inds[i]]['text'] = predictions[i]
+        predictions = self.model.predict(batch)
+        for i in range(len(predictions)):
+            batch_reply[valid_inds[i]]['text'] = predictions[i]
 
         return batch_reply
 
+    def share(self):
+        """Share the model and dicts with copies of this agent, which can then
+        predict or train, e.g. in the processes of HogwildWorld or
+        ParallelEvalWorld. On CPU the network parameters are moved to shared
+        memory, so that all processes use and update the same copy.
+        """
+        if not self.opt['cuda']:
+            self.model.network.share_memory()
+        if not hasattr(self, 'counters'):
+            # examples trained on by each process, for throughput reports
+            self.counters = SharedCounters(
+                ['examples'], self.opt.get('numthreads', 1) + 1)
+        # the copies read a frozen copy of the dictionary, which processes
+        # share without copying (see DictionaryAgent.freeze)
+        frozen = self.dict.freeze()
+        if (not hasattr(self, 'shared_dict') or
+                self.shared_dict.frozen is not frozen):
+            self.shared_dict = create_agent_from_shared(self.dict.share())
+        shared = super().share()
+        shared['word_dict'] = self.shared_dict
+        shared['feature_dict'] = self.feature_dict
+        shared['model'] = self.model
+        shared['counters'] = self.counters
+        return shared
+
     def save(self, filename):
         """Save the parameters of the agent to a file."""
+        self.pipeline.flush()
+        state_dict = {'network': self.model.network.state_dict()}
+        optimizer = self.model.optimizer_state_dict()
+        if optimizer is not None:
+            state_dict['optimizer'] = optimizer
         params = {
-            'state_dict': {
-                'network': self.model.network.state_dict(),
-                'optimizer': self.model.optimizer.state_dict(),
-            },
+            'state_dict': state_dict,
             'word_dict': self.dict,
             'feature_dict': self.feature_dict,
             'config': self.opt,
@@ -223,15 +282,46 @@ class DocReaderAgent(Agent):
     # Helper functions.
     # --------------------------------------------------------------------------
 
+    def shutdown(self):
+        """Train on the examples still queued or pooled, and stop the
+        prefetch threads.
+        """
+        self.pipeline.shutdown()
+
+    def _build_train_batch(self, observations):
+        """Build the examples for a training batch, and batchify them unless
+        they are bucketed later. Run by the prefetch threads, if any.
+        """
+        examples = [self._build_ex(obs) for obs in observations]
+        examples = [ex for ex in examples if ex is not None]
+        batch = None
+        if len(examples) > 0 and self.opt['bucket_pool'] == 0:
+            batch = batchify(examples, null=self.dict['<NULL>'])
+        return examples, batch
+
+    def _update(self, examples, batch=None):
+        """Update the model on one batch of examples."""
+        self._count_examples(len(examples))
+        self.padding.update(padding_ratio([ex[0].size(0) for ex in examples]))
+        if batch is None:
+            batch = batchify(examples, null=self.dict['<NULL>'])
+        self.model.update(batch)
+        self._log()
+
     def _build_ex(self, ex):
         """Find the token span of the answer in the context for this example.
         If a token span cannot be found, return None. Otherwise, torchify.
+        Empty observations (padding the last batches of ordered data) also
+        give None.
         """
+        if 'text' not in ex:
+            return None
         # Split out document + question
         inputs = {}
         fields = ex['text'].split('\n')
         document, question = ' '.join(fields[:-1]), fields[-1]
-        inputs['document'] = self.dict.tokenize(document)
+        tokens, spans, doc_vectors = self._process_document(document)
+        inputs['document'] = tokens
         inputs['question'] = self.dict.tokenize(question)
         inputs['target'] = None
 
@@ -244,30 +334,81 @@ class DocReaderAgent(Agent):
                 return
 
         # Vectorize.
-        inputs = vectorize(self.opt, inputs, self.dict, self.feature_dict)
+        inputs = vectorize(self.opt, inputs, self.dict, self.feature_dict,
+                           doc_vectors)
 
         # Return inputs with original text + spans (keep for prediction)
-        return inputs + (document, self.dict.span_tokenize(document))
+        return inputs + (document, spans)
+
+    def _process_document(self, document):
+        """Tokenize, span tokenize and vectorize a document, or get the result
+        from the cache of recent documents: SQuAD asks several questions about
+        each paragraph. Cached values are shared, so must not be modified.
+        """
+        cache_size = self.opt['doc_cache_size']
+        if cache_size > 0:
+            with self.doc_cache_lock:
+                if document in self.doc_cache:
+                    self.doc_cache.move_to_end(document)
+                    return self.doc_cache[document]
+        tokens = self.dict.tokenize(document)
+        processed = (tokens, self.dict.span_tokenize(document),
+                     vectorize_document(self.opt, tokens, self.dict))
+        if cache_size > 0:
+            with self.doc_cache_lock:
+                self.doc_cache[document] = processed
+                while len(self.doc_cache) > cache_size:
+                    self.doc_cache.popitem(last=False)
+        return processed
 
     def _find_target(self, document, labels):
         """Find the start/end token span for all labels in document.
         Return a random one for training.
         """
-        def _positions(d, l):
-            for i in range(len(d)):
-                for j in range(i, min(len(d) - 1, i + len(l))):
-                    if l == d[i:j + 1]:
-                        yield(i, j)
+        # Labels often repeat (several annotators): tokenize each once
+        tokenized = {}
+        for label in labels:
+            if label not in tokenized:
+                tokenized[label] = self.dict.tokenize(label)
+
+        # Index where the first token of each label occurs, in one pass
+        first_tokens = set(l[0] for l in tokenized.values() if len(l) > 0)
+        positions = {}
+        for i, w in enumerate(document):
+            if w in first_tokens:
+                positions.setdefault(w, []).append(i)
+
         targets = []
         for label in labels:
-            targets.extend(_positions(document, self.dict.tokenize(label)))
+            l = tokenized[label]
+            if len(l) == 0:
+                continue
+            for i in positions.get(l[0], []):
+                j = i + len(l) - 1
+                # spans ending on the last token are not used
+                if j < len(document) - 1 and document[i:j + 1] == l:
+                    targets.append((i, j))
         if len(targets) == 0:
             return
         return targets[np.random.choice(len(targets))]
 
+    def _count_examples(self, n):
+        self.n_examples += n
+        if hasattr(self, 'counters'):
+            self.counters.add('examples', n)
+
     def _log(self):
         if self.model.updates % self.opt['display_iter'] == 0:
             logger.info(
-                '[train] updates = %d | train loss = %.2f | exs = %d' %
-                (self.model.updates, self.model.train_loss.avg, self.n_examples)
+                '[train] updates = %d | train loss = %.2f | exs = %d | '
+                'padding = %.2f' %
+                (self.model.updates, self.model.train_loss.avg, self.n_examples,
+                 self.padding.avg)
             )
+            if self.is_shared:
+                elapsed = self.train_time.time()
+                logger.info(
+                    '[train] pid = %d | exs/sec = %.1f | total exs/sec = %.1f' %
+                    (os.getpid(), self.n_examples / elapsed,
+                     self.counters['examples'] / elapsed)
+                )
@@ -70,6 +70,22 @@ def add_cmdline_args(parser):
                         help='Weight decay (default 0)')
     parser.add_argument('--momentum', type=float, default=0,
                         help='Momentum (default 0)')
+    parser.add_argument('--bucket_pool', type=int, default=0,
+                        help=('Pool this many batches of training examples '
+                              'and cut them into batches of documents of '
+                              'similar length, to reduce padding '
+                              '(default 0, no pooling)'))
+    parser.add_argument('--prefetch_workers', type=int, default=0,
+                        help=('Threads building training batches in the '
+                              'background while the model trains '
+                              '(default 0, build them synchronously)'))
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help=('Max number of training batches being built '
+                              'ahead of the model (default 2)'))
+    parser.add_argument('--doc_cache_size', type=int, default=2000,
+                        help=('Number of tokenized and vectorized documents '
+                              'to keep, as documents are shared by several '
+                              'questions (default 2000, 0 to disable)'))
 
     # Model-specific
     parser.add_argument('--concat_rnn_layers', type='bool', default=True)
@@ -9,6 +9,7 @@ import torch.optim as optim
 import torch.nn.functional as F
 import numpy as np
 import logging
+import copy
 
 from torch.autograd import Variable
 from .utils import load_embeddings, AverageMeter
@@ -59,21 +60,60 @@ class DocReaderModel(object):
         if opt['cuda']:
             self.network.cuda()
 
-        # Building optimizer.
-        logger.info('[ Make optimizer (%s) ]' % opt['optimizer'])
+        # The optimizer is built on the first update, so that models which
+        # never train (e.g. the main process under Hogwild) do not build one.
+        self.optimizer = None
+        if state_dict and 'optimizer' in state_dict:
+            self.optimizer_state = state_dict['optimizer']
+        else:
+            self.optimizer_state = None
+
+    def get_optimizer(self):
+        """Return the optimizer, building it (with the optimizer state of the
+        pretrained model, if any) the first time.
+        """
+        if self.optimizer is None:
+            logger.info('[ Make optimizer (%s) ]' % self.opt['optimizer'])
+            self.optimizer = self._build_optimizer()
+            if self.optimizer_state is not None:
+                self.optimizer.load_state_dict(self.optimizer_state)
+        return self.optimizer
+
+    def optimizer_state_dict(self):
+        """Return the state of the optimizer, or the one loaded with the
+        model if this model has not trained (None if there is neither).
+        Under Hogwild the model of the main process does not train: each
+        process steps its own optimizer, whose state is not saved.
+        """
+        if self.optimizer is not None:
+            return self.optimizer.state_dict()
+        return self.optimizer_state
+
+    def _build_optimizer(self):
+        opt = self.opt
         parameters = filter(lambda p: p.requires_grad,
                             self.network.parameters())
         if opt['optimizer'] == 'sgd':
-            self.optimizer = optim.SGD(parameters, opt['learning_rate'],
-                                       momentum=opt['momentum'],
-                                       weight_decay=opt['weight_decay'])
+            return optim.SGD(parameters, opt['learning_rate'],
+                             momentum=opt['momentum'],
+                             weight_decay=opt['weight_decay'])
         elif opt['optimizer'] == 'adamax':
-            self.optimizer = optim.Adamax(parameters,
-                                          weight_decay=opt['weight_decay'])
+            return optim.Adamax(parameters,
+                                weight_decay=opt['weight_decay'])
         else:
             raise RuntimeError('Unsupported optimizer: %s' % opt['optimizer'])
-        if state_dict and 'optimizer' in state_dict:
-            self.optimizer.load_state_dict(state_dict['optimizer'])
+
+    def shared_copy(self):
+        """Return a model using the same network (and so the same parameters,
+        which are in shared memory on CPU), with its own train statistics and
+        its own optimizer, built if it trains. Hogwild processes each train
+        their own copy, updating the shared parameters without locks.
+        """
+        model = copy.copy(self)
+        model.train_loss = AverageMeter()
+        model.updates = 0
+        model.optimizer = None
+        return model
 
     def update(self, ex):
         # Train mode
@@ -97,7 +137,8 @@ class DocReaderModel(object):
         self.train_loss.update(loss.data[0], ex[0].size(0))
 
         # Clear gradients and run backward
-        self.optimizer.zero_grad()
+        optimizer = self.get_optimizer()
+        optimizer.zero_grad()
         loss.backward()
 
         # Clip gradients
@@ -105,13 +146,14 @@ class DocReaderModel(object):
                                       self.opt['grad_clipping'])
 
         # Update parameters
-        self.optimizer.step()
+        optimizer.step()
         self.updates += 1
 
         # Reset any partially fixed parameters (e.g. rare words)
         self.network.partial_reset()
 
-    def predict(self, ex):
+    def _scores(self, ex):
+        """Return the start and end scores of the network for a batch."""
         # Eval mode
         self.network.eval()
 
@@ -126,20 +168,60 @@ class DocReaderModel(object):
         score_s, score_e = self.network(*inputs)
 
         # Transfer to CPU/normal tensors for numpy ops
-        score_s = score_s.data.cpu()
-        score_e = score_e.data.cpu()
+        score_s = score_s.data.cpu().numpy()
+        score_e = score_e.data.cpu().numpy()
+        return score_s, score_e
 
-        # Get argmax text spans
+    def predict(self, ex):
+        """Return the most likely answer text for each example."""
+        return [answers[0][0] for answers in self.predict_top_k(ex, 1)]
+
+    def predict_top_k(self, ex, top_k):
+        """Return the top_k most likely (answer text, score) pairs for each
+        example, best first.
+        """
+        score_s, score_e = self._scores(ex)
         text = ex[-2]
         spans = ex[-1]
+        max_len = self.opt['max_len'] or score_s.shape[1]
         predictions = []
-        max_len = self.opt['max_len'] or score_s.size(1)
-        for i in range(score_s.size(0)):
-            scores = torch.ger(score_s[i], score_e[i])
-            scores.triu_().tril_(max_len - 1)
-            scores = scores.numpy()
-            s_idx, e_idx = np.unravel_index(np.argmax(scores), scores.shape)
-            s_offset, e_offset = spans[i][s_idx][0], spans[i][e_idx][1]
-            predictions.append(text[i][s_offset:e_offset])
-
+        for i, best in enumerate(decode_spans(score_s, score_e, max_len,
+                                              top_k)):
+            answers = []
+            for s_idx, e_idx, score in best:
+                s_offset, e_offset = spans[i][s_idx][0], spans[i][e_idx][1]
+                answers.append((text[i][s_offset:e_offset], score))
+            predictions.append(answers)
         return predictions
+
+
+def decode_spans(score_s, score_e, max_len, top_k=1):
+    """Find the top_k spans maximizing score_s[start] * score_e[end] with
+    start <= end < start + max_len, for a batch of start and end scores
+    (arrays of batch x len). Only batch x len x max_len products are computed.
+    Returns a list of [(start, end, score)] for each example, best first, and
+    ties broken in favour of the earliest start, then the earliest end.
+    """
+    batch, length = score_s.shape
+    max_len = min(max_len, length)
+    # scores[b, s, k] is the score of the span (s, s + k) of example b
+    scores = np.full((batch, length, max_len), -np.inf, dtype=score_s.dtype)
+    for k in range(max_len):
+        scores[:, :length - k, k] = score_s[:, :length - k] * score_e[:, k:]
+    scores = scores.reshape(batch, -1)
+
+    if top_k == 1:
+        # argmax returns the first maximum, so this gives the earliest span
+        best = np.argmax(scores, axis=1)[:, None]
+    else:
+        best = np.argsort(-scores, axis=1, kind='stable')[:, :top_k]
+    results = []
+    for b in range(batch):
+        spans = []
+        for idx in best[b]:
+            if scores[b, idx] == -np.inf:
+                break
+            start, k = divmod(int(idx), max_len)
+            spans.append((start, start + k, float(scores[b, idx])))
+        results.append(spans)
+    return results
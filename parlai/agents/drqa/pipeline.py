@@ -0,0 +1,112 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+"""Turns batches of training observations into model updates, optionally
+building them in background threads and bucketing examples by length. Does
+not depend on torch, so that it can be tested on its own.
+"""
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TrainPipeline(object):
+    """Queue of training batches between an agent and its model.
+
+    build(observations) returns (examples, batch), where batch may be None.
+    It runs in one of `workers` threads if workers > 0, which are only
+    started the first time they are needed.
+    update(examples, batch) trains on the examples. It always runs in the
+    calling thread, on the batches in the order they were submitted.
+
+    With bucket_pool > 0, examples are pooled until bucket_pool * batchsize
+    of them are collected, then sorted by length(example) and updated on in
+    batches of batchsize cut from the sorted pool, in random order (batch is
+    then None). flush() trains on what is left in the pool, so it must be
+    called at the end of training (shutdown() does).
+    """
+
+    def __init__(self, build, update, batchsize, bucket_pool=0, workers=0,
+                 depth=2, length=len):
+        self.build = build
+        self.update = update
+        self.batchsize = batchsize
+        self.bucket_pool = bucket_pool
+        self.workers = workers
+        self.depth = depth
+        self.length = length
+        self.executor = None
+        # futures of the batches being built, oldest first
+        self.pending = deque()
+        # examples waiting to be bucketed
+        self.pool = []
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers)
+        return self.executor
+
+    def map(self, fn, items):
+        """Returns [fn(item) for item in items], computed by the worker
+        threads if there are any.
+        """
+        if self.workers == 0:
+            return [fn(item) for item in items]
+        return list(self._get_executor().map(fn, items))
+
+    def submit(self, observations):
+        """Queues a training batch, then trains on the oldest batches while
+        more than depth are queued or the oldest one is ready. An exception
+        raised while building a batch is raised here once it is the oldest.
+        """
+        if self.workers == 0:
+            self._train(*self.build(observations))
+            return
+        self.pending.append(self._get_executor().submit(self.build,
+                                                        observations))
+        while self.pending and (len(self.pending) > self.depth or
+                                self.pending[0].done()):
+            self._train(*self.pending.popleft().result())
+
+    def _train(self, examples, batch):
+        if len(examples) == 0:
+            return
+        if self.bucket_pool == 0:
+            self.update(examples, batch)
+            return
+        self.pool.extend(examples)
+        if len(self.pool) >= self.bucket_pool * self.batchsize:
+            self._update_pool()
+
+    def _update_pool(self):
+        pool = sorted(self.pool, key=self.length)
+        self.pool = []
+        batches = [pool[i:i + self.batchsize]
+                   for i in range(0, len(pool), self.batchsize)]
+        for i in np.random.permutation(len(batches)):
+            self.update(batches[i], None)
+
+    def drain(self):
+        """Trains on every queued batch, in order."""
+        while self.pending:
+            self._train(*self.pending.popleft().result())
+
+    def flush(self):
+        """Drains the queue, then trains on the examples left in the bucketing
+        pool, e.g. before predicting or saving, and at the end of training.
+        """
+        self.drain()
+        if self.pool:
+            self._update_pool()
+
+    def shutdown(self):
+        """Flushes the pipeline and stops the worker threads."""
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
@@ -4,9 +4,11 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 import torch
+import numpy as np
+import os
+import tempfile
 import time
 import unicodedata
-from collections import Counter
 
 
 # ------------------------------------------------------------------------------
@@ -18,20 +20,85 @@ def normalize_text(text):
     return unicodedata.normalize('NFD', text)
 
 
+def _convert_embeddings(embedding_file, vocab_file, vectors_file):
+    """Convert a file of space separated embeddings (w e1 ... ed) into a file
+    of normalized words, one per line, and a float32 .npy matrix of their
+    vectors in the same order.
+    """
+    with open(embedding_file) as f:
+        num_words = sum(1 for line in f if line.strip())
+    with open(embedding_file) as f:
+        dim = len(f.readline().rstrip().split(' ')) - 1
+
+    # unique temporary names in the target directory, so that processes
+    # converting the same file at once do not write to the same files
+    tmp_files = []
+    for target in (vocab_file, vectors_file):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)),
+                                   prefix=os.path.basename(target) + '.',
+                                   suffix='.tmp')
+        os.close(fd)
+        tmp_files.append(tmp)
+    tmp_vocab, tmp_vectors = tmp_files
+    try:
+        vectors = np.lib.format.open_memmap(tmp_vectors, mode='w+',
+                                            dtype=np.float32,
+                                            shape=(num_words, dim))
+        with open(embedding_file) as f, open(tmp_vocab, 'w') as vocab:
+            i = 0
+            for line in f:
+                parsed = line.rstrip().split(' ')
+                if len(parsed) == 1 and not parsed[0]:
+                    continue
+                assert(len(parsed) == dim + 1)
+                vocab.write(normalize_text(parsed[0]) + '\n')
+                vectors[i] = np.array(parsed[1:], dtype=np.float32)
+                i += 1
+        vectors.flush()
+        del vectors
+        # vectors last: the pair is only used once both are complete
+        os.replace(tmp_vocab, vocab_file)
+        os.replace(tmp_vectors, vectors_file)
+    finally:
+        for tmp in tmp_files:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def load_embedding_index(embedding_file):
+    """Return (words, vectors) for a file of pretrained embeddings: the list of
+    normalized words and a memory-mapped float32 matrix with their vectors.
+    The text file is converted to a binary copy next to it the first time (or
+    when it changes), which later runs only map into memory.
+    """
+    vocab_file = embedding_file + '.vocab'
+    vectors_file = embedding_file + '.npy'
+    mtime = os.path.getmtime(embedding_file)
+    if not all(os.path.isfile(f) and os.path.getmtime(f) >= mtime
+               for f in (vocab_file, vectors_file)):
+        _convert_embeddings(embedding_file, vocab_file, vectors_file)
+    with open(vocab_file) as f:
+        words = f.read().split('\n')[:-1]
+    vectors = np.load(vectors_file, mmap_mode='r')
+    return words, vectors
+
+
 def load_embeddings(opt, word_dict):
     """Initialize embeddings from file of pretrained vectors."""
     embeddings = torch.Tensor(len(word_dict), opt['embedding_dim'])
     embeddings.normal_(0, 1)
 
     # Fill in embeddings
-    with open(opt['embedding_file']) as f:
-        for line in f:
-            parsed = line.rstrip().split(' ')
-            assert(len(parsed) == opt['embedding_dim'] + 1)
-            w = normalize_text(parsed[0])
-            if w in word_dict:
-                vec = torch.Tensor([float(i) for i in parsed[1:]])
-                embeddings[word_dict[w]].copy_(vec)
+    words, vectors = load_embedding_index(opt['embedding_file'])
+    assert(vectors.shape[1] == opt['embedding_dim'])
+    # for words listed more than once, the last vector is used
+    rows = {w: i for i, w in enumerate(words)}
+    found = [(word_dict[w], rows[w]) for w in word_dict.tok2ind if w in rows]
+    if len(found) > 0:
+        indices, rows = zip(*found)
+        embeddings.index_copy_(
+            0, torch.LongTensor(indices),
+            torch.from_numpy(np.ascontiguousarray(vectors[list(rows)])))
 
     # Zero NULL token
     embeddings[word_dict['<NULL>']].fill_(0)
@@ -55,31 +122,88 @@ def build_feature_dict(opt):
 # ------------------------------------------------------------------------------
 
 
-def vectorize(opt, ex, word_dict, feature_dict):
-    """Turn tokenized text inputs into feature vectors."""
+def word_ids(words, word_dict):
+    """Return the indices of words in word_dict as an int64 array, to compare
+    words by index. Words outside the dictionary get negative ids instead of
+    the index of the unknown token, equal for equal words of the same call.
+    """
+    tok2ind = word_dict.tok2ind
+    unknown = {}
+    ids = np.empty(len(words), dtype=np.int64)
+    for i, w in enumerate(words):
+        idx = tok2ind.get(w)
+        if idx is None:
+            idx = unknown.setdefault(w, -1 - len(unknown))
+        ids[i] = idx
+    return ids
+
+
+def vectorize_document(opt, document, word_dict):
+    """Turn a tokenized document into the feature vectors which do not depend
+    on the question: its word indices, its tf feature (or None) and the
+    word_ids of its tokens and lowercased tokens for the in_question features
+    (or None).
+    """
+    indices = torch.LongTensor([word_dict[w] for w in document])
+    tf = ids = None
+    if len(document) > 0 and (opt['use_tf'] or opt['use_in_question']):
+        uncased = word_ids([w.lower() for w in document], word_dict)
+        if opt['use_tf']:
+            _, words = np.unique(uncased, return_inverse=True)
+            counts = np.bincount(words)[words]
+            tf = torch.from_numpy((counts / len(document)).astype(np.float32))
+        if opt['use_in_question']:
+            ids = (word_ids(document, word_dict), uncased)
+    return indices, tf, ids
+
+
+def in_question(doc_ids, question_ids, document, question, lower=False):
+    """Return a float mask of the document tokens found in the question, given
+    the word_ids of both (of their lowercased tokens if lower). Words outside
+    the dictionary are compared as strings.
+    """
+    mask = np.isin(doc_ids, question_ids[question_ids >= 0])
+    unknown = np.flatnonzero(doc_ids < 0)
+    if len(unknown) > 0:
+        words = set(question[i] for i in np.flatnonzero(question_ids < 0))
+        if lower:
+            words = set(w.lower() for w in words)
+            mask[unknown] = [document[i].lower() in words for i in unknown]
+        else:
+            mask[unknown] = [document[i] in words for i in unknown]
+    return mask.astype(np.float32)
+
+
+def vectorize(opt, ex, word_dict, feature_dict, doc_vectors=None):
+    """Turn tokenized text inputs into feature vectors.
+    doc_vectors may hold the output of vectorize_document for ex['document'].
+    """
     # Index words
-    document = torch.LongTensor([word_dict[w] for w in ex['document']])
+    if doc_vectors is None:
+        doc_vectors = vectorize_document(opt, ex['document'], word_dict)
+    document, tf, doc_ids = doc_vectors
     question = torch.LongTensor([word_dict[w] for w in ex['question']])
 
     # Create extra features vector
     features = torch.zeros(len(ex['document']), len(feature_dict))
 
     # f_{exact_match}
-    if opt['use_in_question']:
-        q_words_cased = set([w for w in ex['question']])
-        q_words_uncased = set([w.lower() for w in ex['question']])
-        for i in range(len(ex['document'])):
-            if ex['document'][i] in q_words_cased:
-                features[i][feature_dict['in_question']] = 1.0
-            if ex['document'][i].lower() in q_words_uncased:
-                features[i][feature_dict['in_question_uncased']] = 1.0
+    if opt['use_in_question'] and len(ex['document']) > 0:
+        doc_cased, doc_uncased = doc_ids
+        q = ex['question']
+        cased = in_question(doc_cased, word_ids(q, word_dict),
+                            ex['document'], q)
+        uncased = in_question(doc_uncased,
+                              word_ids([w.lower() for w in q], word_dict),
+                              ex['document'], q, lower=True)
+        features[:, feature_dict['in_question']].copy_(
+            torch.from_numpy(cased))
+        features[:, feature_dict['in_question_uncased']].copy_(
+            torch.from_numpy(uncased))
 
     # f_{tf}
-    if opt['use_tf']:
-        counter = Counter([w.lower() for w in ex['document']])
-        l = len(ex['document'])
-        for i, w in enumerate(ex['document']):
-            features[i][feature_dict['tf']] = counter[w.lower()] * 1.0 / l
+    if opt['use_tf'] and len(ex['document']) > 0:
+        features[:, feature_dict['tf']].copy_(tf)
 
     # Maybe return without target
     if ex['target'] is None:
@@ -137,6 +261,11 @@ def batchify(batch, null=0):
     raise RuntimeError('Wrong number of inputs per batch')
 
 
+def padding_ratio(lengths):
+    """Fraction of a batch of sequences with these lengths that is padding."""
+    return 1 - sum(lengths) / (len(lengths) * max(lengths))
+
+
 # ------------------------------------------------------------------------------
 # General logging utilities.
 # ------------------------------------------------------------------------------
@@ -153,8 +153,9 @@ class ParsedRemoteAgent(RemoteAgent):
         you need to know where those are.
         """
         if split_lines:
-            return [self.dict.parse(line, vec_type=list)
-                    for line in s.split('\n')]
+            vecs, lengths = self.dict.batch_txt2vec(s.split('\n'))
+            return [vec[:length] for vec, length in zip(vecs.tolist(),
+                                                         lengths)]
         else:
             return self.dict.parse(s, vec_type=list)
 
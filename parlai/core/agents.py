@@ -157,6 +157,42 @@ class Teacher(Agent):
         return report
 
 
+def _get_task_module(opt):
+    """Returns the agents module of a single task "task_dir:teacher_class"."""
+    sp = opt['task'].strip().split(':')
+    if '.' in sp[0]:
+        module_name = sp[0]
+    else:
+        task = sp[0].lower()
+        module_name = "parlai.tasks.%s.agents" % (task)
+    return importlib.import_module(module_name)
+
+
+def _get_teacher_class(opt):
+    """Returns the teacher class of a single task "task_dir:teacher_class"."""
+    sp = opt['task'].strip().split(':')
+    if len(sp) > 1:
+        sp[1] = sp[1][0].upper() + sp[1][1:]
+        teacher = sp[1]
+        if '.' not in sp[0] and 'Teacher' not in teacher:
+            # Append "Teacher" to class name by default if
+            # a complete path is not given.
+            teacher += "Teacher"
+    else:
+        teacher = "DefaultTeacher"
+    return getattr(_get_task_module(opt), teacher)
+
+
+def get_task_teacher_class(opt):
+    """Returns the class of the teacher created for a single task, without
+    creating it, or None if the task creates its agents with a create_agents
+    function instead (see _create_task_agents).
+    """
+    if hasattr(_get_task_module(opt), 'create_agents'):
+        return None
+    return _get_teacher_class(opt)
+
+
 def create_task_agent_from_taskname(opt):
     """Creates task agent(s) assuming the input "task_dir:teacher_class"
     e.g. def_string is a shorthand path like "babi:Task1k:1" or "#babi"
@@ -166,23 +202,7 @@ def create_task_agent_from_taskname(opt):
     """
     if ',' not in opt['task']:
         # Single task
-        sp = opt['task'].strip().split(':')
-        if '.' in sp[0]:
-            module_name = sp[0]
-        else:
-            task = sp[0].lower()
-            module_name = "parlai.tasks.%s.agents" % (task)
-        if len(sp) > 1:
-            sp[1] = sp[1][0].upper() + sp[1][1:]
-            teacher = sp[1]
-            if '.' not in sp[0] and 'Teacher' not in teacher:
-                # Append "Teacher" to class name by default if
-                # a complete path is not given.
-                teacher += "Teacher"
-        else:
-            teacher = "DefaultTeacher"
-        my_module = importlib.import_module(module_name)
-        teacher_class = getattr(my_module, teacher)
+        teacher_class = _get_teacher_class(opt)
         task_agents = teacher_class(opt)
         if type(task_agents) != list:
             task_agents = [task_agents]
@@ -8,10 +8,31 @@ from .agents import Teacher
 from .thread_utils import SharedTable
 from .metrics import Metrics
 
+import array
+import bisect
 import copy
+import hashlib
+import mmap
+import numpy as np
+import os
+import pickle
 import random
+import re
+import shutil
 import sys
+import tempfile
 import time
+import weakref
+
+
+def file_signature(path):
+    """Returns a (path, mtime, size) tuple identifying the current contents
+    of a file, or None if path is None or does not exist.
+    """
+    if path is None or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_mtime, stat.st_size)
 
 
 class DialogTeacher(Teacher):
@@ -22,12 +43,21 @@ class DialogTeacher(Teacher):
     - metrics tracking count of sent vs correctly answered queries
 
     If you have opt.numthreads > 1, this also activates a shared memory
-    array for the data and lock-protected shared-memory metrics.
+    array for the data and lock-free shared-memory metrics.
+
+    Ordered data can be split into shards (see shard()), so that several
+    teachers sharing the same data and metrics together see every example
+    exactly once.
 
     In order to subclass this class, you must implement setup_data() in your
     class (or subclass another class which does, like FbDialogTeacher), which
     reads your data file as an iterator. See the data module for a description
     of the requirements for setup_data().
+
+    If opt['datafile_cache'] is set and the class implements cache_key(), the
+    processed data is saved next to the datafile after the first run and
+    loaded from there afterwards instead of calling setup_data() again.
+    Setting opt['dialog_data'] to 'mmap' stores the data with MmapDialogData.
     """
 
     def __init__(self, opt, shared=None):
@@ -49,23 +79,31 @@ class DialogTeacher(Teacher):
         if shared and shared.get('data'):
             self.data = shared['data']
         else:
-            self.data = DialogData(self.setup_data(opt['datafile']),
-                                   cands=self.label_candidates())
+            self.data = self._build_data(opt)
 
         if shared and shared.get('metrics'):
             self.metrics = shared['metrics']
         else:
             self.metrics = Metrics(opt)
 
-        self.reset()
+        self.shard_index, self.num_shards = self.shard()
+        # metrics are new or shared: copies must not clear the metrics other
+        # copies (maybe in other processes) are already updating
+        self._reset_dialog()
 
     def reset(self):
         # Reset the dialog so that it is at the start of the epoch,
         # and all metrics are reset.
         self.metrics.clear()
+        self._reset_dialog()
+
+    def _reset_dialog(self):
         self.lastY = None
+        self.lastLabelCandidates = None
         self.episode_idx = -1
-        self.epochDone = False
+        # a shard may be empty if there are more shards than episodes
+        self.epochDone = (not self.random and
+                          self.shard_index >= self.data.num_episodes())
         self.episode_done = True
 
     def __len__(self):
@@ -88,6 +126,64 @@ class DialogTeacher(Teacher):
         shared['metrics'] = self.metrics
         return shared
 
+    def shard(self):
+        """Returns (index, count) such that this teacher only visits the ordered
+        episodes whose position modulo count is index, ending its epoch after
+        the last of them. BatchWorld sets opt['batchindex'] for each member of
+        the batch and ParallelEvalWorld sets opt['threadindex'] in each of its
+        processes to split the data between them.
+        """
+        index, count = 0, 1
+        if self.opt.get('batchindex', -1) >= 0:
+            index, count = self.opt['batchindex'], self.opt['batchsize']
+        if self.opt.get('threadindex', -1) >= 0:
+            index += self.opt['threadindex'] * count
+            count *= self.opt['numthreads']
+        return index, count
+
+    def _build_data(self, opt):
+        """Creates the DialogData for opt['datafile'], using the backend set by
+        opt['dialog_data'] (mmap by default when the data is shared between
+        processes, so that they attach to the same pages) and going through
+        the on-disk cache if it is enabled and the teacher supports it.
+        """
+        # python objects shared with forked processes get copied page by page
+        # as their refcounts change, so use the mmap backend for hogwild
+        # training and parallel evaluation. other worlds (e.g. validation
+        # during hogwild training) run in a single process
+        shared = opt.get('numthreads', 1) > 1 and (
+            opt.get('datatype') == 'train' or opt.get('parallel_eval', False))
+        default = 'mmap' if shared else 'memory'
+        if opt.get('dialog_data', default) == 'mmap':
+            data_class = MmapDialogData
+        else:
+            data_class = DialogData
+        key = None
+        if opt.get('datafile_cache', False):
+            key = self.cache_key(opt)
+        if key is None:
+            return data_class(self.setup_data(opt['datafile']),
+                              cands=self.label_candidates())
+
+        cache_path = data_class.cache_path(opt['datafile'], key)
+        if os.path.exists(cache_path):
+            print('[loading cached dialog data: ' + cache_path + ']')
+            return data_class.load(cache_path)
+        data = data_class(self.setup_data(opt['datafile']),
+                          cands=self.label_candidates())
+        data.save(cache_path)
+        if os.path.exists(cache_path):
+            data_class.remove_old_caches(opt['datafile'], cache_path)
+        return data
+
+    def cache_key(self, opt):
+        """Returns None by default, meaning the data is not cached. Override
+        this in children (such as FbDialogTeacher) to return a picklable value
+        which changes whenever the output of setup_data() would change, e.g.
+        the signatures of the files it reads plus any options it depends on.
+        """
+        return None
+
     def label_candidates(self):
         """Returns None by default, but override this in children (such as
         FbDialogTeacher) to load up candidate labels for every example.
@@ -96,27 +192,44 @@ class DialogTeacher(Teacher):
 
     def observe(self, observation):
         """Store observation and process for metrics. """
+        labels, label_cands = self.observe_unscored(observation)
+        if labels is not None:
+            self.metrics.update(observation, labels, label_cands)
+
+    def observe_unscored(self, observation):
+        """Store observation without updating the metrics. Returns the labels
+        and label candidates of the example it replies to, or (None, None) if
+        there is nothing to score. BatchWorld uses this to score a whole batch
+        with a single call to Metrics.batch_update.
+        """
         self.observation = observation
-        if self.lastY is not None:
-            obs = self.observation if hasattr(self, 'observation') else {}
-            loss = self.metrics.update(
-                obs, self.lastY, self.lastLabelCandidates)
-            self.lastY = None
-            self.lastLabelCandidates = None
+        labels, label_cands = self.lastY, self.lastLabelCandidates
+        self.lastY = None
+        self.lastLabelCandidates = None
+        return labels, label_cands
 
     def next_example(self):
+        num_eps = self.data.num_episodes()
         if self.episode_done:
-            num_eps = self.data.num_episodes()
             if self.random:
                 # select random episode
                 self.episode_idx = random.randrange(num_eps)
+            elif (self.episode_idx < 0 or
+                  self.episode_idx + self.num_shards >= num_eps):
+                # start again from the first episode of this shard
+                self.episode_idx = self.shard_index
             else:
-                # select next episode
-                self.episode_idx = (self.episode_idx + 1) % num_eps
+                # select next episode of this shard
+                self.episode_idx += self.num_shards
             self.entry_idx = 0
         else:
             self.entry_idx += 1
-        return self.data.get(self.episode_idx, self.entry_idx)
+        action, end_of_data = self.data.get(self.episode_idx, self.entry_idx)
+        if not self.random:
+            # the epoch ends with the last episode of this shard
+            end_of_data = (action['episode_done'] and
+                           self.episode_idx + self.num_shards >= num_eps)
+        return action, end_of_data
 
     def act(self):
         """Send new dialog message. """
@@ -162,11 +275,19 @@ class DialogData(object):
 
     random tells the data class whether or not to visit episodes sequentially
     or randomly when returning examples to the caller.
+
+    A loaded DialogData can be written to disk with save() and read back in a
+    single pass with load(), skipping the data_loader entirely.
     """
 
+    # bump this whenever the stored format changes to invalidate old caches
+    CACHE_VERSION = 2
+    CACHE_SUFFIX = '.cache'
+
     def __init__(self, data_loader, cands=None):
         self.data = []
         self._load(data_loader)
+        self._build_index()
         self.cands = None if cands == None else set(sys.intern(c) for c in cands)
         self.addedCands = []
 
@@ -174,10 +295,31 @@ class DialogData(object):
         """Returns total number of entries available. Each episode has at least
         one entry, but might have many more.
         """
-        length = 0
-        for l in self.data:
-            length += len(l)
-        return length
+        return int(self.entry_offsets[-1])
+
+    def _build_index(self):
+        """Builds the prefix sums of the episode lengths: entry_offsets[i] is
+        the global index of the first entry of episode i, and the last value
+        is the total number of entries.
+        """
+        self.entry_offsets = array.array('q', [0])
+        for episode in self.data:
+            self.entry_offsets.append(self.entry_offsets[-1] + len(episode))
+
+    def locate(self, index):
+        """Returns the (episode_idx, entry_idx) of the entry with the given
+        global index, in O(log(num_episodes)).
+        """
+        if not 0 <= index < len(self):
+            raise IndexError('entry index out of range')
+        episode_idx = bisect.bisect_right(self.entry_offsets, index) - 1
+        return episode_idx, index - self.entry_offsets[episode_idx]
+
+    def random_entry(self):
+        """Returns the (episode_idx, entry_idx) of an entry picked uniformly
+        at random over all entries (rather than over episodes).
+        """
+        return self.locate(random.randrange(len(self)))
 
     def _load(self, data_loader):
         """Loads up data from an iterator over tuples described in the class
@@ -226,17 +368,89 @@ class DialogData(object):
         if len(episode) > 0:
             self.data.append(tuple(episode))
 
+    @classmethod
+    def cache_path(cls, datafile, key):
+        """Returns the path of the cache file for datafile under the given
+        cache key.
+        """
+        digest = hashlib.sha1(
+            repr((cls.__name__, cls.CACHE_VERSION, key)).encode('utf-8')
+        ).hexdigest()
+        return '{}.{}{}'.format(datafile, digest[:16], cls.CACHE_SUFFIX)
+
+    @classmethod
+    def remove_old_caches(cls, datafile, keep):
+        """Removes the caches of datafile written by this class other than
+        keep, i.e. those of older versions of the file or of the class.
+        """
+        directory, name = os.path.split(datafile)
+        pattern = re.compile(re.escape(name) + r'\.[0-9a-f]{16}' +
+                             re.escape(cls.CACHE_SUFFIX) + '$')
+        for entry in os.listdir(directory or '.'):
+            path = os.path.join(directory, entry)
+            if not pattern.match(entry) or os.path.samefile(path, keep):
+                continue
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                # e.g. removed by another process at the same time
+                pass
+
+    @staticmethod
+    def load(path):
+        """Loads a DialogData previously written with save()."""
+        with open(path, 'rb') as read:
+            return pickle.load(read)
+
+    def save(self, path):
+        """Writes this DialogData to path. The file is written to a temporary
+        name first, so concurrent readers never see a partial file.
+        Failing to write the cache is not fatal.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as write:
+                pickle.dump(self, write, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print('[could not write dialog data cache {}: {}]'.format(path, e))
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
     def num_episodes(self):
         """Return number of episodes in the dataset."""
         return len(self.data)
 
+    def _episode_length(self, episode_idx):
+        """Returns the number of entries in the given episode."""
+        return (self.entry_offsets[episode_idx + 1] -
+                self.entry_offsets[episode_idx])
+
+    def _get_entry(self, episode_idx, entry_idx):
+        """Returns the stored (text[, labels[, reward[, cands]]]) tuple."""
+        return self.data[episode_idx][entry_idx]
+
     def get(self, episode_idx, entry_idx=0):
-        """Returns a specific entry from the dataset."""
+        """Returns a specific entry from the dataset. Negative indices count
+        from the end, as for lists.
+        """
+        num_eps = self.num_episodes()
+        if not -num_eps <= episode_idx < num_eps:
+            raise IndexError('episode index out of range')
+        # the prefix sums are only valid for non-negative indices
+        episode_idx %= num_eps
+        length = self._episode_length(episode_idx)
+        if not -length <= entry_idx < length:
+            raise IndexError('entry index out of range')
+        entry_idx %= length
+
         # first look up data
-        episode = self.data[episode_idx]
-        entry = episode[entry_idx]
-        episode_done = entry_idx == len(episode) - 1
-        end_of_data = episode_done and episode_idx == len(self.data) - 1
+        entry = self._get_entry(episode_idx, entry_idx)
+        episode_done = entry_idx == length - 1
+        end_of_data = episode_done and episode_idx == self.num_episodes() - 1
 
         # now pack it in a action-observation dictionary
         table = {}
@@ -268,3 +482,220 @@ class DialogData(object):
         # last entry in this episode
         table['episode_done'] = episode_done
         return table, end_of_data
+
+
+def _remove_owned_dir(path, owner_pid):
+    """Removes path, unless called from a process forked from its owner."""
+    if os.getpid() == owner_pid:
+        shutil.rmtree(path, True)
+
+
+class MmapDialogData(DialogData):
+    """DialogData backend which keeps the dataset on disk instead of as Python
+    objects, for corpora too large to hold as tuples of strings.
+
+    Every distinct string is stored once, UTF-8 encoded, in one contiguous
+    buffer. Labels and label candidates are stored as runs of string ids.
+    Numpy arrays hold the string offsets, the entries (one row each) and the
+    index of the first entry of each episode. All of these are memory-mapped read-only, so only the
+    pages actually touched are resident and `get` only decodes the strings of
+    the requested entry.
+
+    path is the directory holding the files. If it already contains a
+    complete dataset, it is opened and data_loader is never iterated.
+    Otherwise the data is written there, or to a temporary directory (removed
+    when this object is collected) if path is None.
+
+    Since the data lives in the page cache, processes forked from the owner
+    (e.g. by HogwildWorld) read the same physical pages, and pickling only
+    sends the path: the receiving process maps the files itself, so sharing
+    costs the same whatever the size of the dataset.
+    """
+
+    # columns of the entries array
+    ARITY, TEXT, LABELS_START, LABELS_END, REWARD, CANDS_START, CANDS_END = \
+        range(7)
+    # special values for string ids / item runs
+    NONE = -1
+    SAME_CANDS = -2
+    CACHE_SUFFIX = '.cache.d'
+
+    def __init__(self, data_loader, cands=None, path=None):
+        self.path = path
+        self._cleanup = None
+        if path is None:
+            self.path = tempfile.mkdtemp(prefix='parlai_dialog_')
+            self._cleanup = weakref.finalize(self, _remove_owned_dir,
+                                             self.path, os.getpid())
+        if not os.path.isfile(os.path.join(self.path, 'entries.npy')):
+            self._write(data_loader, cands)
+        self._open()
+        self.addedCands = []
+
+    def _write(self, data_loader, cands):
+        """Streams the data_loader to disk. The entries array is written
+        last, so its presence marks a complete dataset.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        str_ids = {}
+        str_offsets = array.array('q', [0])
+        items = array.array('q')
+        entries = array.array('q')
+        entry_offsets = array.array('q', [0])
+        blob = open(os.path.join(self.path, 'strings.bin'), 'wb')
+
+        def add_str(s):
+            if s is None:
+                return self.NONE
+            idx = str_ids.get(s)
+            if idx is None:
+                data = s.encode('utf-8')
+                blob.write(data)
+                idx = len(str_offsets) - 1
+                str_offsets.append(str_offsets[-1] + len(data))
+                str_ids[s] = idx
+            return idx
+
+        def add_items(lst):
+            if lst is None:
+                return self.NONE, self.NONE
+            start = len(items)
+            items.extend(add_str(e) for e in lst)
+            return start, len(items)
+
+        num_entries = 0
+        last_cands = None
+        with blob:
+            for entry, new in data_loader:
+                if new and num_entries > entry_offsets[-1]:
+                    entry_offsets.append(num_entries)
+                    last_cands = None
+                row = [min(len(entry), 4), self.NONE, self.NONE, self.NONE,
+                       self.NONE, self.NONE, self.NONE]
+                if len(entry) > 0:
+                    row[self.TEXT] = add_str(entry[0])
+                if len(entry) > 1:
+                    row[self.LABELS_START:self.LABELS_END + 1] = \
+                        add_items(entry[1])
+                if len(entry) > 2:
+                    row[self.REWARD] = add_str(entry[2])
+                if len(entry) > 3 and entry[3] is not None:
+                    if last_cands and entry[3] is last_cands:
+                        row[self.CANDS_START] = self.SAME_CANDS
+                    else:
+                        last_cands = entry[3]
+                        row[self.CANDS_START:self.CANDS_END + 1] = \
+                            add_items(entry[3])
+                elif len(entry) > 3:
+                    # DialogData drops a trailing None for the candidates
+                    row[self.ARITY] = 3
+                entries.extend(row)
+                num_entries += 1
+        if num_entries > entry_offsets[-1]:
+            entry_offsets.append(num_entries)
+
+        def save(name, arr, shape=None):
+            arr = np.frombuffer(arr, dtype=np.int64) if len(arr) else \
+                np.zeros(0, dtype=np.int64)
+            if shape is not None:
+                arr = arr.reshape(shape)
+            np.save(os.path.join(self.path, name), arr)
+
+        save('str_offsets.npy', str_offsets)
+        save('items.npy', items)
+        save('entry_offsets.npy', entry_offsets)
+        with open(os.path.join(self.path, 'cands.pkl'), 'wb') as write:
+            pickle.dump(None if cands is None else list(cands), write)
+        save('entries.npy', entries, (num_entries, 7))
+
+    def _open(self):
+        """Memory-maps the files in self.path."""
+        def load(name):
+            return np.load(os.path.join(self.path, name), mmap_mode='r')
+        self.str_offsets = load('str_offsets.npy')
+        self.items = load('items.npy')
+        self.entries = load('entries.npy')
+        self.entry_offsets = load('entry_offsets.npy')
+        with open(os.path.join(self.path, 'strings.bin'), 'rb') as read:
+            if self.str_offsets[-1] > 0:
+                self.strings = mmap.mmap(read.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            else:
+                # mmap refuses empty files
+                self.strings = b''
+        with open(os.path.join(self.path, 'cands.pkl'), 'rb') as read:
+            cands = pickle.load(read)
+        self.cands = None if cands is None else set(
+            sys.intern(c) for c in cands)
+
+    def __getstate__(self):
+        """Only the location of the files is pickled."""
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        """Attaches to the files of the pickled object, read-only. The
+        copy never removes them.
+        """
+        self.path = state['path']
+        self._cleanup = None
+        self._open()
+        self.addedCands = []
+
+    @staticmethod
+    def load(path):
+        return MmapDialogData(None, path=path)
+
+    def save(self, path):
+        """Copies the files to path. The copy is made under a temporary name
+        first, so concurrent readers never see a partial directory.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            shutil.copytree(self.path, tmp_path)
+            os.rename(tmp_path, path)
+        except OSError as e:
+            print('[could not write dialog data cache {}: {}]'.format(path, e))
+            shutil.rmtree(tmp_path, True)
+
+    def locate(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('entry index out of range')
+        episode_idx = int(np.searchsorted(self.entry_offsets, index,
+                                          side='right')) - 1
+        return episode_idx, index - int(self.entry_offsets[episode_idx])
+
+    def num_episodes(self):
+        return len(self.entry_offsets) - 1
+
+    def _episode_length(self, episode_idx):
+        return int(self.entry_offsets[episode_idx + 1] -
+                   self.entry_offsets[episode_idx])
+
+    def _str(self, idx):
+        if idx < 0:
+            return None
+        start = int(self.str_offsets[idx])
+        end = int(self.str_offsets[idx + 1])
+        return sys.intern(self.strings[start:end].decode('utf-8'))
+
+    def _items(self, start, end):
+        if start < 0:
+            return None
+        return tuple(self._str(i) for i in self.items[start:end].tolist())
+
+    def _get_entry(self, episode_idx, entry_idx):
+        row = self.entries[self.entry_offsets[episode_idx] + entry_idx].tolist()
+        arity = row[self.ARITY]
+        entry = [self._str(row[self.TEXT])]
+        if arity > 1:
+            entry.append(self._items(row[self.LABELS_START],
+                                     row[self.LABELS_END]))
+        if arity > 2:
+            entry.append(self._str(row[self.REWARD]))
+        if arity > 3:
+            if row[self.CANDS_START] == self.SAME_CANDS:
+                entry.append(sys.intern('same as last time'))
+            else:
+                entry.append(self._items(row[self.CANDS_START],
+                                         row[self.CANDS_END]))
+        return tuple(entry[:max(arity, 1)])
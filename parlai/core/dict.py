@@ -6,43 +6,328 @@
 """Contains code for parsing and building a dictionary from text."""
 
 from .agents import Agent
-from .thread_utils import SharedTable
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+try:
+    # python3
+    from collections.abc import Mapping
+except ImportError:
+    # python2
+    from collections import Mapping
+from multiprocessing import Pool, RawArray
 import copy
+import math
 import numpy as np
 import nltk
+import os
+import re
+import shutil
+import threading
+import zlib
 
+# numbers (maybe with decimals), words, or single punctuation characters
+TOKEN_RE = re.compile(r'\d+(?:[.,]\d+)*|\w+|[^\w\s]')
 
-def find_ngrams(token_dict, text, n):
-    """Breaks text into ngrams that appear in token_dict."""
-    # base case
+
+def build_ngram_trie(token_dict):
+    """Builds a trie of the tokens of the multi-word entries of token_dict, as
+    nested dicts from token to child node. The None key marks the nodes where
+    an entry ends.
+    """
+    trie = {}
+    for entry in token_dict:
+        if ' ' in entry:
+            _trie_insert(trie, entry)
+    return trie
+
+
+def _trie_insert(trie, entry):
+    """Adds the multi-word entry to a trie built by build_ngram_trie."""
+    node = trie
+    for token in entry.split(' '):
+        node = node.setdefault(token, {})
+    node[None] = True
+
+
+def _ngram_matches(trie, text, n):
+    """Returns, for each position of text, the set of sizes (2 to n) of the
+    entries of the trie which start there.
+    """
+    matches = []
+    for i in range(len(text)):
+        sizes = set()
+        node = trie
+        for m in range(min(n, len(text) - i)):
+            node = node.get(text[i + m])
+            if node is None:
+                break
+            if m > 0 and None in node:
+                sizes.add(m + 1)
+        matches.append(sizes)
+    return matches
+
+
+def _segment_ngrams(text, lo, hi, n, matches, out):
+    """Appends the tokens of text[lo:hi] to out, joining the n-grams found
+    from left to right, then looking for smaller n-grams in between them.
+    """
     if n <= 1:
-        return text
-    # tokens committed to output
-    saved_tokens = []
-    # tokens remaining to be searched in sentence
-    search_tokens = text[:]
-    # tokens stored until next ngram found
-    next_search = []
-    while len(search_tokens) >= n:
-        ngram = ' '.join(search_tokens[:n])
-        if ngram in token_dict:
+        out.extend(text[lo:hi])
+        return
+    # start of the tokens not covered by an n-gram yet
+    gap = lo
+    i = lo
+    while i + n <= hi:
+        if n in matches[i]:
             # first, search previous unmatched words for smaller ngrams
-            sub_n = min(len(next_search), n - 1)
-            saved_tokens.extend(find_ngrams(token_dict, next_search, sub_n))
-            next_search.clear()
+            _segment_ngrams(text, gap, i, min(i - gap, n - 1), matches, out)
             # then add this ngram
-            saved_tokens.append(ngram)
-            # then pop this ngram from the remaining words to search
-            search_tokens = search_tokens[n:]
+            out.append(' '.join(text[i:i + n]))
+            i += n
+            gap = i
         else:
-            next_search.append(search_tokens.pop(0))
-    remainder = next_search + search_tokens
-    sub_n = min(len(remainder), n - 1)
-    saved_tokens.extend(find_ngrams(token_dict, remainder, sub_n))
+            i += 1
+    _segment_ngrams(text, gap, hi, min(hi - gap, n - 1), matches, out)
+
+
+def find_ngrams(token_dict, text, n, trie=None):
+    """Breaks text into ngrams that appear in token_dict.
+
+    Ngrams of n tokens are found first, from left to right, then the tokens
+    between them are searched for smaller ngrams. trie can give the output of
+    build_ngram_trie(token_dict), which is otherwise built on every call.
+    """
+    # base case
+    if n <= 1:
+        return text
+    if trie is None:
+        trie = build_ngram_trie(token_dict)
+    saved_tokens = []
+    _segment_ngrams(text, 0, len(text), n, _ngram_matches(trie, text, n),
+                    saved_tokens)
     return saved_tokens
 
 
+def _shared_array(values, dtype):
+    """Returns a numpy array with these values, backed by shared memory."""
+    values = np.asarray(values, dtype=dtype)
+    ctype = np.ctypeslib.as_ctypes_type(values.dtype)
+    # RawArray needs at least one element to give a valid buffer
+    array = np.frombuffer(RawArray(ctype, max(len(values), 1)),
+                          dtype=values.dtype)[:len(values)]
+    array[:] = values
+    return array
+
+
+class _FrozenMap(Mapping):
+    """Read-only mapping view over a FrozenDictionary."""
+
+    def __init__(self, frozen, getitem, keys):
+        self._getitem = getitem
+        self._keys = keys
+        self._frozen = frozen
+
+    def __getitem__(self, key):
+        return self._getitem(key)
+
+    def __iter__(self):
+        return self._keys()
+
+    def __len__(self):
+        return len(self._frozen)
+
+
+class FrozenDictionary(object):
+    """Read-only, compact copy of the tokens and frequencies of a dictionary.
+
+    The tokens are kept in index order as one utf-8 blob with an array of
+    offsets into it, along with an open-addressing hash table of their
+    indices (keyed by the crc32 of the token, with linear probing and at most
+    half of the slots used) and an array of their frequencies. The arrays are
+    in shared memory, so other processes use them without copying, or
+    memory-mapped from the directory written by save().
+
+    tok2ind, ind2tok and freq are read-only mappings with the same contents as
+    the corresponding dicts of DictionaryAgent.
+    """
+
+    FILES = ['blob', 'offsets', 'table', 'freqs']
+
+    def __init__(self, tokens, freqs, arrays=None):
+        """Builds the arrays from tokens, in index order, and their freqs.
+        arrays can instead give the arrays themselves (see load()).
+        """
+        if arrays is None:
+            encoded = [tok.encode('utf-8') for tok in tokens]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(tok) for tok in encoded], out=offsets[1:])
+            blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            arrays = {
+                'blob': _shared_array(blob, np.uint8),
+                'offsets': _shared_array(offsets, np.int64),
+                'table': _shared_array(self._build_table(encoded), np.int64),
+                'freqs': _shared_array(freqs, np.int64),
+            }
+        self.blob = arrays['blob']
+        self.offsets = arrays['offsets']
+        self.table = arrays['table']
+        self.freqs = arrays['freqs']
+        self._init_views()
+
+        self.tok2ind = _FrozenMap(self, self.index, self.tokens)
+        self.ind2tok = _FrozenMap(self, self.token, self.indices)
+        self.freq = _FrozenMap(self, self.frequency, self.tokens)
+
+    @staticmethod
+    def _build_table(encoded):
+        """Returns the hash table of the indices of the encoded tokens, with
+        -1 in the empty slots. Its size is a power of two.
+        """
+        size = 2
+        while size < 2 * len(encoded):
+            size *= 2
+        mask = size - 1
+        table = [-1] * size
+        for index, key in enumerate(encoded):
+            slot = zlib.crc32(key) & mask
+            while table[slot] >= 0:
+                slot = (slot + 1) & mask
+            table[slot] = index
+        return table
+
+    def _init_views(self):
+        # memoryviews read single values much faster than numpy indexing
+        self._blob = memoryview(self.blob)
+        self._offsets = memoryview(self.offsets)
+        self._table = memoryview(self.table)
+        self._mask = len(self.table) - 1
+
+    def __getstate__(self):
+        """Leaves out the memoryviews, which cannot be pickled."""
+        state = self.__dict__.copy()
+        for name in ['_blob', '_offsets', '_table']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_views()
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        """Builds a FrozenDictionary from a DictionaryAgent."""
+        tokens = [dictionary.ind2tok[i] for i in range(len(dictionary))]
+        freqs = [dictionary.freq.get(tok, 0) for tok in tokens]
+        return cls(tokens, freqs)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _encoded(self, index):
+        return self._blob[self._offsets[index]:self._offsets[index + 1]]
+
+    def token(self, index):
+        """Returns the token with this index, or raises KeyError."""
+        if (not isinstance(index, (int, np.integer)) or
+                index < 0 or index >= len(self)):
+            raise KeyError(index)
+        return str(self._encoded(index), 'utf-8')
+
+    def index(self, token):
+        """Returns the index of this token, or raises KeyError."""
+        if not isinstance(token, str):
+            raise KeyError(token)
+        key = token.encode('utf-8')
+        slot = zlib.crc32(key) & self._mask
+        while True:
+            index = self._table[slot]
+            if index < 0:
+                raise KeyError(token)
+            if self._encoded(index) == key:
+                return index
+            slot = (slot + 1) & self._mask
+
+    def frequency(self, token):
+        """Returns the frequency of this token, or raises KeyError."""
+        return int(self.freqs[self.index(token)])
+
+    def tokens(self):
+        """Iterates over the tokens in index order."""
+        return (self.token(i) for i in range(len(self)))
+
+    def indices(self):
+        return iter(range(len(self)))
+
+    def save(self, path):
+        """Saves the arrays as .npy files in the directory path, which load()
+        memory-maps. The directory is written under a temporary name first.
+        """
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in self.FILES:
+            np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a FrozenDictionary saved in the directory path."""
+        arrays = {name: np.load(os.path.join(path, name + '.npy'),
+                                mmap_mode='r')
+                  for name in cls.FILES}
+        return cls(None, None, arrays=arrays)
+
+
+class CountMinSketch(object):
+    """Approximate counts of tokens in a fixed amount of memory: depth rows of
+    width counters, where each token increments one counter per row. The
+    estimate of a count is the smallest of its counters, which is never below
+    the true count, and above by at most 2 * total / width with probability
+    1 - 2^-depth.
+
+    The columns come from double hashing of the crc32 and adler32 checksums of
+    the token, which are the same in every process, so that the sketches of
+    several processes can be added up.
+    """
+
+    def __init__(self, width, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _cells(self, tokens):
+        """Returns the (rows, columns) of the counters of tokens, as arrays of
+        len(tokens) x depth.
+        """
+        data = [tok.encode('utf-8') for tok in tokens]
+        h1 = np.array([zlib.crc32(d) for d in data], dtype=np.int64)
+        h2 = np.array([zlib.adler32(d) | 1 for d in data], dtype=np.int64)
+        steps = np.arange(self.depth, dtype=np.int64)
+        cols = (h1[:, None] + steps[None, :] * h2[:, None]) % self.width
+        return np.broadcast_to(steps, cols.shape), cols
+
+    def add(self, tokens):
+        """Counts one more occurrence of each of tokens, and returns their
+        estimated counts after adding all of them.
+        """
+        if len(tokens) == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows, cols = self._cells(tokens)
+        np.add.at(self.table, (rows, cols), 1)
+        return self.table[rows, cols].min(axis=1)
+
+    def estimate(self, tokens):
+        """Returns the estimated counts of tokens."""
+        if len(tokens) == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows, cols = self._cells(tokens)
+        return self.table[rows, cols].min(axis=1)
+
+    def merge(self, table):
+        """Adds the counts of the table of a sketch of the same size."""
+        self.table += table
+
+
 class DictionaryAgent(Agent):
     """Builds and/or loads a dictionary.
 
@@ -55,8 +340,13 @@ class DictionaryAgent(Agent):
     default_lang = 'english'
     default_maxngram = -1
     default_minfreq = 0
+    default_maxtokens = -1
+    default_sketch_width = 0
+    default_sketch_depth = 4
     default_null = '<NULL>'
     default_unk = '<UNK>'
+    default_tokenizer = 'punkt'
+    default_cache_size = 0
 
     @staticmethod
     def add_cmdline_args(argparser):
@@ -67,22 +357,58 @@ class DictionaryAgent(Agent):
         argparser.add_arg(
             '--dict-loadpath',
             help='path to a saved dictionary to load tokens / counts from to ' +
-                 'seed the dictionary with initial tokens and/or frequencies')
+                 'seed the dictionary with initial tokens and/or frequencies.' +
+                 ' a directory saved by save_frozen is memory-mapped instead,' +
+                 ' and the dictionary is then read-only')
+        argparser.add_arg(
+            '--dict-tokenizer', default=DictionaryAgent.default_tokenizer,
+            choices=['punkt', 'regex', 'split'],
+            help='tokenizer: punkt splits sentences with the nltk punkt ' +
+                 'tokenizer and then words with the treebank tokenizer, ' +
+                 'regex finds words and punctuation with a regular ' +
+                 'expression (much faster), split splits on whitespace')
+        argparser.add_arg(
+            '--dict-cache-size', default=DictionaryAgent.default_cache_size,
+            type=int,
+            help='number of strings whose tokens are kept in an lru cache, so ' +
+                 'that texts seen again (e.g. every epoch) are not tokenized ' +
+                 'again. 0 disables the cache')
         argparser.add_arg(
             '--dict-language', default=DictionaryAgent.default_lang,
             help='sets language for the punkt sentence tokenizer')
         argparser.add_arg(
             '--dict-max-ngram-size', default=DictionaryAgent.default_maxngram,
+            type=int,
             help='looks for ngrams of up to this size. this is ignored when ' +
-                 'building the dictionary. note: this takes approximate ' +
-                 'runtime of len(sentence)^max_ngram_size')
+                 'building the dictionary. ngrams are matched with a trie of ' +
+                 'the multi-word entries, in about len(sentence) * ' +
+                 'max_ngram_size steps')
         argparser.add_arg(
             '--dict-nulltoken', default=DictionaryAgent.default_null,
             help='empty token, can be used for padding or just empty values')
-        # TODO(ahm): minfreq isn't actually being used, add the functionality
         argparser.add_arg(
             '--dict-minfreq', default=DictionaryAgent.default_minfreq,
-            help='minimum frequency of words to include them in the dictionary')
+            type=int,
+            help='minimum frequency of words to include them in the ' +
+                 'dictionary, applied when sorting (and so saving) it')
+        argparser.add_arg(
+            '--dict-maxtokens', default=DictionaryAgent.default_maxtokens,
+            type=int,
+            help='max number of tokens to keep, the most frequent ones, ' +
+                 'applied when sorting (and so saving) the dictionary. ' +
+                 '-1 for no limit. the null and unknown tokens are always kept')
+        argparser.add_arg(
+            '--dict-sketch-width', default=DictionaryAgent.default_sketch_width,
+            type=int,
+            help='if above 0, new tokens are counted in a count-min sketch ' +
+                 'of this many counters per row when building, and only ' +
+                 'added to the dictionary once their estimated count reaches ' +
+                 '--dict-minfreq, so that rare tokens take no memory. their ' +
+                 'frequencies are then estimates, which may be too high')
+        argparser.add_arg(
+            '--dict-sketch-depth', default=DictionaryAgent.default_sketch_depth,
+            type=int,
+            help='number of rows of the count-min sketch')
         argparser.add_arg(
             '--dict-unktoken', default=DictionaryAgent.default_unk,
             help='token to return for unavailable words')
@@ -94,11 +420,34 @@ class DictionaryAgent(Agent):
         self.unk_token = opt.get('dict_unktoken')
         self.max_ngram_size = opt.get('dict_max_ngram_size',
                                       self.default_maxngram)
+        self.minfreq = opt.get('dict_minfreq', self.default_minfreq)
+        self.maxtokens = opt.get('dict_maxtokens', self.default_maxtokens)
+        self.sketch = None
+
+        # counts changes to the tokens and freqs, to know when the frozen copy
+        # is out of date, and to the multi-word tokens, for the ngram trie
+        # used by tokenize. they are kept in lists shared with the writable
+        # copies of this dictionary
+        self._version = [0]
+        self._ngram_version = [0]
+        self.frozen = None
+        self.frozen_version = None
+        self.trie = None
+        self.trie_version = None
 
-        if shared:
-            self.freq = shared.get('freq', SharedTable({}))
-            self.tok2ind = shared.get('tok2ind', SharedTable({}))
-            self.ind2tok = shared.get('ind2tok', SharedTable({}))
+        if shared and 'frozen' in shared:
+            self._use_frozen(shared['frozen'])
+        elif shared:
+            self._version = shared['version']
+            self._ngram_version = shared['ngram_version']
+            self.freq = shared['freq']
+            self.tok2ind = shared['tok2ind']
+            self.ind2tok = shared['ind2tok']
+            self.sketch = shared['sketch']
+        elif opt.get('dict_loadpath') and os.path.isdir(opt['dict_loadpath']):
+            print('Dictionary: loading frozen dictionary from {}.'.format(
+                  opt['dict_loadpath']))
+            self._use_frozen(FrozenDictionary.load(opt['dict_loadpath']))
         else:
             self.freq = defaultdict(int)
             self.tok2ind = {}
@@ -114,21 +463,29 @@ class DictionaryAgent(Agent):
                 self.tok2ind[self.unk_token] = index
                 self.ind2tok[index] = self.unk_token
 
-            if opt.get('dict_load_path'):
+            if opt.get('dict_loadpath'):
                 # load existing dictionary
-                self.load(opt.get('dict_load_path'))
+                self.load(opt.get('dict_loadpath'))
 
         # initialize tokenizers
-        st_path = 'tokenizers/punkt/{0}.pickle'.format(opt.get('dict_language'))
-        try:
-            self.sent_tok = nltk.data.load(st_path)
-        except LookupError:
-            nltk.download('punkt')
-            self.sent_tok = nltk.data.load(st_path)
+        self.tokenizer = opt.get('dict_tokenizer', self.default_tokenizer)
+        if self.tokenizer == 'punkt':
+            st_path = 'tokenizers/punkt/{0}.pickle'.format(
+                opt.get('dict_language'))
+            try:
+                self.sent_tok = nltk.data.load(st_path)
+            except LookupError:
+                nltk.download('punkt')
+                self.sent_tok = nltk.data.load(st_path)
 
-        self.word_tok = nltk.tokenize.treebank.TreebankWordTokenizer()
+            self.word_tok = nltk.tokenize.treebank.TreebankWordTokenizer()
 
-        if not shared:
+        # the lru cache keeps the tokens before ngrams are found, which do
+        # not depend on the contents of the dictionary
+        self.cache_size = opt.get('dict_cache_size', self.default_cache_size)
+        self._init_cache()
+
+        if not shared and self.frozen is None:
             if self.null_token:
                 # fix count for null token to one billion and one
                 self.freq[self.null_token] = 1000000001
@@ -140,6 +497,65 @@ class DictionaryAgent(Agent):
             if opt.get('dict_savepath'):
                 self.save_path = opt['dict_savepath']
 
+            sketch_width = opt.get('dict_sketch_width',
+                                   self.default_sketch_width)
+            if sketch_width > 0:
+                self.sketch = CountMinSketch(
+                    sketch_width,
+                    opt.get('dict_sketch_depth', self.default_sketch_depth))
+
+    def _init_cache(self):
+        # (text, building) -> output of _split_words, most recently used last
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # tokenize may be called by several threads
+        self.cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        """Leaves the tokenization cache out when pickling, e.g. when a model
+        saves its dictionary, and the frozen copy unless it is in use.
+        """
+        state = self.__dict__.copy()
+        for key in ['cache', 'cache_hits', 'cache_misses', 'cache_lock']:
+            state.pop(key, None)
+        if not self.frozen_is_used():
+            state['frozen'] = None
+            state['frozen_version'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    @property
+    def version(self):
+        return self._version[0]
+
+    @version.setter
+    def version(self, value):
+        self._version[0] = value
+
+    @property
+    def ngram_version(self):
+        return self._ngram_version[0]
+
+    @ngram_version.setter
+    def ngram_version(self, value):
+        self._ngram_version[0] = value
+
+    def _use_frozen(self, frozen):
+        """Uses the maps of a FrozenDictionary, making this one read-only."""
+        self.frozen = frozen
+        self.frozen_version = self.version
+        self.freq = frozen.freq
+        self.tok2ind = frozen.tok2ind
+        self.ind2tok = frozen.ind2tok
+
+    def _check_writable(self):
+        if self.frozen_is_used():
+            raise RuntimeError('Frozen dictionaries are read-only.')
+
     def __contains__(self, key):
         """If key is an int, returns whether the key is in the indices.
         If key is a str, return if the token is in the dict of tokens.
@@ -170,58 +586,158 @@ class DictionaryAgent(Agent):
         """If the key is not in the dictionary, add it to the dictionary and set
         its frequency to value.
         """
+        self._check_writable()
+        self.version += 1
         key = str(key)
         self.freq[key] = int(value)
         if key not in self.tok2ind:
-            index = len(self.tok2ind)
-            self.tok2ind[key] = index
-            self.ind2tok[index] = key
+            self._add_token(key)
+
+    def _add_token(self, token):
+        """Gives token the next index."""
+        index = len(self.tok2ind)
+        self.tok2ind[token] = index
+        self.ind2tok[index] = token
+        if ' ' in token:
+            # an ngram: add it to the trie if it is up to date, rather than
+            # building it again
+            if (self.trie is not None and
+                    self.trie_version == self.ngram_version):
+                _trie_insert(self.trie, token)
+                self.trie_version += 1
+            self.ngram_version += 1
 
     def _sent_tokenize(self, text, building=False):
         """Uses nltk-trained PunktTokenizer for sentence tokenization"""
         text = text.replace('|', ' ' if building else ' __pipe__ ')
         return self.sent_tok.tokenize(text)
 
-    def _word_tokenize(self, text, building=False):
-        """Uses nltk Treebank Word Tokenizer for tokenizing words within
-        sentences.
-        """
-        word_tokens = self.word_tok.tokenize(text)
-
+    def _find_ngrams(self, word_tokens, building=False):
         if not building and self.max_ngram_size > 1:
             # search for ngrams during parse-time
             # TODO(ahm): support build-time ngrams using word2vec heuristic?
-            word_tokens = find_ngrams(self.tok2ind, word_tokens,
-                                      self.max_ngram_size)
+            word_tokens = find_ngrams(self.tok2ind, list(word_tokens),
+                                      self.max_ngram_size, self._ngram_trie())
         return word_tokens
 
+    def _ngram_trie(self):
+        """Returns the trie of the ngrams of the dictionary, rebuilding it if
+        ngrams were removed since, or added by a copy of the dictionary.
+        """
+        if self.trie is None or self.trie_version != self.ngram_version:
+            self.trie = build_ngram_trie(self.tok2ind)
+            self.trie_version = self.ngram_version
+        return self.trie
+
+    def _split_words(self, text, building=False):
+        """Returns a tuple with the tuple of word tokens of each sentence of
+        text (a single one for the regex and split tokenizers), before ngrams
+        are found.
+        """
+        if self.tokenizer == 'punkt':
+            # TODO(ahm): this should be easy to parallelize, since we don't
+            # care about sentence order here
+            return tuple(tuple(self.word_tok.tokenize(sent))
+                         for sent in self._sent_tokenize(text, building))
+        text = text.replace('|', ' ' if building else ' __pipe__ ')
+        if self.tokenizer == 'regex':
+            return (tuple(TOKEN_RE.findall(text)),)
+        return (tuple(text.split()),)
+
+    def _cached_split_words(self, text, building=False):
+        """Returns _split_words(text, building), from the cache if it holds
+        it (and --dict-cache-size is above 0).
+        """
+        if self.cache_size <= 0:
+            return self._split_words(text, building)
+        key = (text, building)
+        with self.cache_lock:
+            sentences = self.cache.get(key)
+            if sentences is not None:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                return sentences
+            self.cache_misses += 1
+        sentences = self._split_words(text, building)
+        with self.cache_lock:
+            self.cache[key] = sentences
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return sentences
+
     def tokenize(self, text, building=False):
         """Returns a sequence of tokens from the iterable."""
-        # TODO(ahm): this should be easy to parallelize, since we don't care
-        # about sentence order here
-        return (token for sent in self._sent_tokenize(text, building)
-                for token in self._word_tokenize(sent, building))
+        sentences = self._cached_split_words(text, building)
+        if self.tokenizer == 'punkt':
+            return (token for sent in sentences
+                    for token in self._find_ngrams(sent, building))
+        return list(self._find_ngrams(sentences[0], building))
+
+    def tokenize_cache_info(self):
+        """Returns the hits, misses and size of the tokenization cache, or None
+        if it is disabled. Each copy of the dictionary has its own cache.
+        """
+        if self.cache_size <= 0:
+            return None
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'size': len(self.cache)}
 
     def add_to_dict(self, tokens):
         """ Builds dictionary from the list of provided tokens."""
+        self._check_writable()
+        self.version += 1
+        if self.sketch is not None:
+            self._add_to_sketch(list(tokens))
+            return
         for token in tokens:
             self.freq[token] += 1
             if token not in self.tok2ind:
-                index = len(self.tok2ind)
-                self.tok2ind[token] = index
-                self.ind2tok[index] = token
+                self._add_token(token)
+
+    def _add_to_sketch(self, tokens):
+        """Counts tokens in the sketch. Tokens already in the dictionary are
+        counted exactly, and the others are added, with their estimated count,
+        once it reaches minfreq.
+        """
+        added = set()
+        for token, estimate in zip(tokens, self.sketch.add(tokens)):
+            if token in added:
+                # already counted in the estimate
+                continue
+            if token in self.tok2ind:
+                self.freq[token] += 1
+            elif estimate >= self.minfreq:
+                self.freq[token] = int(estimate)
+                self._add_token(token)
+                added.add(token)
+
+    def _reindex(self, tokens):
+        """Keeps only tokens, in this order, reindexing them from 0. The maps
+        are changed in place, as writable copies of the dictionary share them.
+        """
+        freqs = {tok: self.freq[tok] for tok in tokens}
+        if any(' ' in tok for tok in self.tok2ind if tok not in freqs):
+            # ngrams were removed
+            self.ngram_version += 1
+        self.tok2ind.clear()
+        self.tok2ind.update((tok, i) for i, tok in enumerate(tokens))
+        self.ind2tok.clear()
+        self.ind2tok.update(enumerate(tokens))
+        self.freq.clear()
+        self.freq.update(freqs)
+
+    def _is_special(self, token):
+        return token == self.null_token or token == self.unk_token
 
     def remove_tail(self, min_freq):
-        to_remove = []
-        for token, freq in self.freq.items():
-            if freq < min_freq:
-                # queue up removals since can't mutate dict during iteration
-                to_remove.append(token)
-                # other dicts can be modified as we go
-                idx = self.tok2idx.pop(token)
-                del self.ind2tok[idx]
-        for token in to_remove:
-            del self.freq[token]
+        """Removes the tokens seen less than min_freq times (except the null
+        and unknown tokens), reindexing the others in the same order.
+        """
+        self._check_writable()
+        self.version += 1
+        self._reindex([self.ind2tok[i] for i in sorted(self.ind2tok)
+                       if self.freq[self.ind2tok[i]] >= min_freq or
+                       self._is_special(self.ind2tok[i])])
 
     def load(self, filename):
         """Load pre-existing dictionary in 'token[<TAB>count]' format.
@@ -229,15 +745,15 @@ class DictionaryAgent(Agent):
         """
         print('Dictionary: loading existing dictionary from {}.'.format(
               filename))
+        self._check_writable()
+        self.version += 1
         with open(filename) as read:
             for line in read:
                 split = line.strip().split('\t')
                 token = split[0]
                 cnt = int(split[1]) if len(split) > 1 else 0
                 self.freq[token] = cnt
-                index = len(self.tok2ind)
-                self.tok2ind[token] = index
-                self.ind2tok[index] = token
+                self._add_token(token)
 
     def save(self, filename, append=False, sort=True):
         """Save dictionary to file.
@@ -248,7 +764,7 @@ class DictionaryAgent(Agent):
         If sort (default true), then first sort the dictionary before saving.
         """
         print('Dictionary: saving dictionary to {}.'.format(filename))
-        if sort:
+        if sort and not self.frozen_is_used():
             self.sort()
         with open(filename, 'a' if append else 'w') as write:
             for i in range(len(self.ind2tok)):
@@ -256,21 +772,27 @@ class DictionaryAgent(Agent):
                 cnt = self.freq[tok]
                 write.write('{tok}\t{cnt}\n'.format(tok=tok, cnt=cnt))
 
-    def sort(self):
+    def sort(self, trim=True):
         """Sorts the dictonary, so that the elements with the lowest index have
         the highest counts. This reindexes the dictionary according to the
         sorted frequencies, breaking ties alphabetically by token.
+        If trim (default true), then the tokens seen less than --dict-minfreq
+        times are removed, and only the --dict-maxtokens most frequent ones
+        are kept. The null and unknown tokens are always kept.
+        Returns the list of (token, count) pairs kept, in the new order.
         """
         # sort first by count, then alphabetically
+        self._check_writable()
+        self.version += 1
         sorted_pairs = sorted(self.freq.items(), key=lambda x: (-x[1], x[0]))
-        new_tok2ind = {}
-        new_ind2tok = {}
-        for i, (tok, _) in enumerate(sorted_pairs):
-            new_tok2ind[tok] = i
-            new_ind2tok[i] = tok
-        self.tok2ind = new_tok2ind
-        self.ind2tok = new_ind2tok
-        return sorted_pairs
+        tokens = [tok for tok, cnt in sorted_pairs
+                  if not trim or cnt >= self.minfreq or self._is_special(tok)]
+        if trim and 0 <= self.maxtokens < len(tokens):
+            tokens = (tokens[:self.maxtokens] +
+                      [tok for tok in tokens[self.maxtokens:]
+                       if self._is_special(tok)])
+        self._reindex(tokens)
+        return [(tok, self.freq[tok]) for tok in tokens]
 
     def parse(self, txt_or_vec, vec_type=np.ndarray):
         """Convenience function for parsing either text or vectors of indices.
@@ -292,7 +814,7 @@ class DictionaryAgent(Agent):
         if vec_type == np.ndarray:
             res = np.fromiter(
                 (self[token] for token in self.tokenize(str(text))),
-                np.int
+                int
             )
         else:
             res = vec_type((self[token] for token in self.tokenize(str(text))))
@@ -305,6 +827,41 @@ class DictionaryAgent(Agent):
         """
         return delimiter.join(self[int(idx)] for idx in vector)
 
+    def batch_txt2vec(self, texts, max_len=None, pad=None):
+        """Converts a list of strings to a matrix of indices, one row per
+        string, truncated to max_len tokens (if set) and padded with pad
+        (defaults to the index of the null token, or 0 without one).
+        Strings repeated in the list are only tokenized once.
+        Returns (matrix, lengths), an int32 array of len(texts) x the longest
+        row and an array of the number of tokens in each row.
+        """
+        if pad is None:
+            pad = self.tok2ind.get(self.null_token, 0)
+        vectors = {}
+        rows = []
+        for text in texts:
+            text = str(text)
+            if text not in vectors:
+                vectors[text] = [self[token] for token in self.tokenize(text)]
+            rows.append(vectors[text][:max_len])
+        lengths = np.array([len(row) for row in rows], dtype=np.int32)
+        width = int(lengths.max()) if len(rows) > 0 else 0
+        matrix = np.full((len(rows), width), pad, dtype=np.int32)
+        for i, row in enumerate(rows):
+            matrix[i, :len(row)] = row
+        return matrix, lengths
+
+    def batch_vec2txt(self, matrix, lengths=None, delimiter=' '):
+        """Converts a matrix of indices (or a list of vectors) into a list of
+        strings, one per row. If lengths is set, each row is cut to its length
+        first, e.g. to drop the padding added by batch_txt2vec.
+        """
+        if isinstance(matrix, np.ndarray):
+            matrix = matrix.tolist()
+        if lengths is not None:
+            matrix = [row[:length] for row, length in zip(matrix, lengths)]
+        return [self.vec2txt(row, delimiter) for row in matrix]
+
     def act(self):
         """Add any words passed in the 'text' field of the observation to this
         dictionary.
@@ -317,15 +874,58 @@ class DictionaryAgent(Agent):
                         self.add_to_dict(self.tokenize(text))
         return {}
 
+    def freeze(self):
+        """Returns a FrozenDictionary with the current tokens and frequencies,
+        reusing the last one if the dictionary has not changed since. Until the
+        dictionary changes again, share() then shares it instead of the
+        writable maps.
+        """
+        if self.frozen is None or self.frozen_version != self.version:
+            self.frozen = FrozenDictionary.from_dict(self)
+            self.frozen_version = self.version
+        return self.frozen
+
+    def save_frozen(self, path, sort=True):
+        """Saves the dictionary in the directory path as a FrozenDictionary,
+        which is memory-mapped when loaded with --dict-loadpath.
+        If sort (default true), then first sort the dictionary before saving.
+        """
+        print('Dictionary: saving frozen dictionary to {}.'.format(path))
+        if sort and not self.frozen_is_used():
+            self.sort()
+        self.freeze().save(path)
+
+    def frozen_is_used(self):
+        """Whether this dictionary uses the maps of a FrozenDictionary (it was
+        shared frozen or loaded from one), and so is read-only.
+        """
+        return self.frozen is not None and self.frozen.tok2ind is self.tok2ind
+
     def share(self):
-        """Creates shared-memory versions of the internal maps."""
-        self.freq = SharedTable(self.freq)
-        self.tok2ind = SharedTable(self.tok2ind)
-        self.ind2tok = SharedTable(self.ind2tok)
+        """Shares the dictionary with copies of it, e.g. the agents of a
+        BatchWorld or HogwildWorld.
+
+        Call freeze() before sharing a dictionary which is done being built
+        (or load one saved with save_frozen()), so that the copies use the
+        compact form. Until then, the copies are writable and use the same
+        maps as this dictionary. Copies in other processes start from a copy
+        of them, and their changes are not seen by the others: use
+        build_dict_parallel to build a dictionary with several processes.
+        Once frozen (and not changed since), or if it was loaded frozen, the
+        copies instead use the compact FrozenDictionary, also without copying
+        it in other processes, and are read-only.
+        """
         shared = {}
-        shared['freq'] = self.freq
-        shared['tok2ind'] = self.tok2ind
-        shared['ind2tok'] = self.ind2tok
+        if self.frozen is not None and (self.frozen_is_used() or
+                                        self.frozen_version == self.version):
+            shared['frozen'] = self.frozen
+        else:
+            shared['version'] = self._version
+            shared['ngram_version'] = self._ngram_version
+            shared['freq'] = self.freq
+            shared['tok2ind'] = self.tok2ind
+            shared['ind2tok'] = self.ind2tok
+            shared['sketch'] = self.sketch
         shared['opt'] = self.opt
         shared['class'] = type(self)
         return shared
@@ -334,3 +934,102 @@ class DictionaryAgent(Agent):
         """Save on shutdown if savepath is set."""
         if hasattr(self, 'save_path'):
             self.save(self.save_path)
+
+
+class _DictionaryShard(Agent):
+    """Passes every count-th observation, starting with the index-th, on to a
+    dictionary, so that several processes can split building it.
+    """
+
+    def __init__(self, opt, dictionary, index, count):
+        super().__init__(opt)
+        self.dictionary = dictionary
+        self.index = index
+        self.count = count
+        self.seen = 0
+
+    def act(self):
+        if self.seen % self.count == self.index:
+            self.dictionary.observe(self.observation)
+            self.dictionary.act()
+        self.seen += 1
+        return {}
+
+
+def _run_dict_worlds(opt, agent, datatypes):
+    """Runs one ordered pass over each datatype with this agent."""
+    from .worlds import create_task
+    for datatype in datatypes:
+        opt['datatype'] = datatype
+        world = create_task(opt, agent)
+        while not world.epoch_done():
+            world.parley()
+
+
+def _count_tokens(args):
+    """Counts the tokens that a new dictionary of class dict_class adds when
+    shown the index-th of every count examples of datatypes.
+    """
+    dict_class, opt, datatypes, index, count = args
+    dictionary = dict_class(opt)
+    initial = dict(dictionary.freq)
+    _run_dict_worlds(opt, _DictionaryShard(opt, dictionary, index, count),
+                     datatypes)
+    counts = Counter({tok: cnt - initial.get(tok, 0)
+                      for tok, cnt in dictionary.freq.items()
+                      if cnt != initial.get(tok, 0)})
+    if dictionary.sketch is not None:
+        return counts, dictionary.sketch.table
+    return counts, None
+
+
+def build_dict_parallel(dictionary, opt, datatypes, num_workers):
+    """Adds the tokens of one ordered pass over each of the datatypes of
+    opt['task'] to dictionary, using num_workers processes.
+
+    Each process goes over all of the data, but only tokenizes every
+    num_workers-th example, in a new dictionary of the same class built from
+    opt. Their counts are then added up, so the frequencies (and the order of
+    the dictionary once sorted) are the same as when building it serially.
+    """
+    opt = copy.deepcopy(opt)
+    # the workers are the only processes, and go over examples one by one
+    opt['numthreads'] = 1
+    opt['batchsize'] = 1
+    if num_workers <= 1:
+        _run_dict_worlds(opt, dictionary, datatypes)
+        return dictionary
+
+    sketch = dictionary.sketch
+    if sketch is not None:
+        # a token seen minfreq times in total is seen at least
+        # minfreq / num_workers times by one of the workers
+        opt['dict_minfreq'] = int(math.ceil(dictionary.minfreq / num_workers))
+    args = [(type(dictionary), opt, datatypes, i, num_workers)
+            for i in range(num_workers)]
+    with Pool(num_workers) as pool:
+        results = pool.map(_count_tokens, args)
+    total = Counter()
+    for count, _ in results:
+        total.update(count)
+    if sketch is None:
+        for tok in sorted(total):
+            dictionary[tok] = dictionary.freq.get(tok, 0) + total[tok]
+        return dictionary
+
+    # tokens already in the dictionary (e.g. loaded from --dict-loadpath)
+    # were counted exactly by the workers too. the others were only counted
+    # once a worker kept them, so use the estimates of all of their
+    # occurrences instead
+    new_counts = CountMinSketch(sketch.width, sketch.depth)
+    for _, table in results:
+        new_counts.merge(table)
+    sketch.merge(new_counts.table)
+    tokens = sorted(tok for tok in total if tok not in dictionary.tok2ind)
+    for tok in sorted(total):
+        if tok in dictionary.tok2ind:
+            dictionary[tok] = dictionary.freq[tok] + total[tok]
+    for tok, estimate in zip(tokens, new_counts.estimate(tokens)):
+        if estimate >= dictionary.minfreq:
+            dictionary[tok] = int(estimate)
+    return dictionary
@@ -34,7 +34,7 @@ In general dialog in this format can be any speech, not just QA pairs:
 etc.
 """
 
-from .dialog_teacher import DialogTeacher
+from .dialog_teacher import DialogTeacher, file_signature
 
 
 class FbDialogTeacher(DialogTeacher):
@@ -51,7 +51,18 @@ class FbDialogTeacher(DialogTeacher):
 
     def label_candidates(self):
         return self.cands
-    
+
+    def cache_key(self, opt):
+        """The parsed data only depends on the datafile, the candidates file
+        and the options read by setup_data.
+        """
+        if type(self).setup_data is not FbDialogTeacher.setup_data:
+            # subclass parses the file its own way, don't guess
+            return None
+        return (file_signature(opt['datafile']),
+                file_signature(opt.get('cands_datafile', None)),
+                self.cloze)
+
     def load_cands(self, path):
         """Load global fixed set of candidate labels that the teacher provides every
         example (the true labels for a specific example are also added to this set,
@@ -89,18 +100,6 @@ class FbDialogTeacher(DialogTeacher):
         return cands
 
 
-    def keep_dialog(self, index):
-        if (self.random and self.opt.get('batchsize', 0) > 1 and
-            self.opt.get('batchindex', -1) >= 0):
-            # For ordered data in batch mode, we split the
-            # data into equal parts for each member of the batch
-            # so that the data does not repeat.
-            print(str(self.opt['batchindex']) + " " + str(self.opt['batchsize']))
-            return (self.opt['batchindex'] %  self.opt['batchsize']) == 0
-        else:
-            return True
-
-
     def setup_data(self, path):
         """Reads data in the fbdialog format.
         Returns ((x,y,r,c), new_episode?) tuples.
@@ -128,7 +127,6 @@ class FbDialogTeacher(DialogTeacher):
             start = True
             x = ''
             reward = None
-            dialog_index = 0
             for line in read:
                 line = line.strip()
                 if len(line) == 0:
@@ -156,11 +154,9 @@ class FbDialogTeacher(DialogTeacher):
 
                 # now check if we're at a new episode
                 if conv_id == '1':
-                    dialog_index += 1
                     x = x.strip()
                     if x:
-                        if self.keep_dialog(dialog_index):
-                            yield [x, None, reward], start
+                        yield [x, None, reward], start
                     start = True
                     # start a new episode
                     if self.cloze:
@@ -187,12 +183,10 @@ class FbDialogTeacher(DialogTeacher):
                         # split label_candidates
                         split[3] = split[3].split('|')
                     if start:
-                        if self.keep_dialog(dialog_index):
-                            yield split, True
+                        yield split, True
                         start = False
                     else:
-                        if self.keep_dialog(dialog_index):
-                            yield split, False
+                        yield split, False
                     # reset x in case there is unlabeled data still left
                     x = ''
                     reward = None
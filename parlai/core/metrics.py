@@ -4,35 +4,30 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 """Provides standard metric evaluations for dialog.
-Uses locking and shared memory when numthreads is set to >1 to share metrics
-between processes.
+Uses shared memory when numthreads is set to >1 to share metrics between
+processes. Each process adds to its own row of counters, so updates do not
+need any locking; the rows are summed when reporting.
 """
 
-from .thread_utils import SharedTable
+from .thread_utils import SharedCounters
 from collections import Counter
 import copy
+import functools
 import importlib
 import random
 import re
 import string
 
 
-def _normalize_answer(s):
-    """Lower text and remove punctuation, articles and extra whitespace."""
-    def remove_articles(text):
-        return re.sub(r'\b(a|an|the)\b', ' ', text)
-
-    def white_space_fix(text):
-        return ' '.join(text.split())
+# compiled once, shared by all normalization calls
+_ARTICLES = re.compile(r'\b(a|an|the)\b')
+_PUNCTUATION = str.maketrans('', '', string.punctuation)
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
 
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+def _normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace."""
+    s = s.lower().translate(_PUNCTUATION)
+    return ' '.join(_ARTICLES.sub(' ', s).split())
 
 
 def _exact_match(guess, answers):
@@ -65,8 +60,51 @@ def _f1_score(guess, answers):
     return max(scores)
 
 
+def _normalize_tokens(s):
+    """Returns the normalized form of s, its number of tokens and the counts
+    of each token, i.e. everything needed to compare an answer to a guess.
+    """
+    s = _normalize_answer(s)
+    tokens = s.split()
+    return s, len(tokens), Counter(tokens)
+
+
+def _score_answers(guess, answers, normalize):
+    """Returns (exact match, max F1) of guess against answers, like
+    _exact_match and _f1_score but normalizing the guess only once.
+    normalize is called on each answer to get its _normalize_tokens result,
+    so that it can be cached.
+    """
+    if guess is None or answers is None:
+        return 0, 0
+    g_norm, g_len, g_counts = _normalize_tokens(guess)
+    correct = 0
+    best_f1 = 0
+    for a in answers:
+        a_norm, a_len, a_counts = normalize(a)
+        if g_norm == a_norm:
+            correct = 1
+        num_same = sum((g_counts & a_counts).values())
+        if num_same == 0:
+            continue
+        precision = 1.0 * num_same / g_len
+        recall = 1.0 * num_same / a_len
+        f1 = (2 * precision * recall) / (precision + recall)
+        best_f1 = max(best_f1, f1)
+    return correct, best_f1
+
+
 class Metrics(object):
-    """Class that maintains evaluation metrics over dialog."""
+    """Class that maintains evaluation metrics over dialog.
+
+    Labels of fixed datasets are scored again every epoch, so their
+    normalized tokens are kept in an LRU cache of opt['metrics_cache_size']
+    entries (0 disables it). The cache is local to each process; its hits
+    and misses in this process are only included in report() when
+    opt['metrics_cache_report'] is set, for debugging.
+    """
+
+    default_cache_size = 10000
 
     def __init__(self, opt):
         self.metrics = {}
@@ -77,8 +115,17 @@ class Metrics(object):
         for k in self.eval_pr:
             self.metrics['hits@' + str(k)] = 0
         if opt.get('numthreads', 1) > 1:
-            self.metrics = SharedTable(self.metrics)
+            # one row for each thread, plus one for the main process
+            self.metrics = SharedCounters(self.metrics.keys(),
+                                          opt['numthreads'] + 1)
         self.datatype = opt.get('datatype', 'train')
+        cache_size = opt.get('metrics_cache_size', self.default_cache_size)
+        if cache_size > 0:
+            self._normalize_label = functools.lru_cache(cache_size)(
+                _normalize_tokens)
+        else:
+            self._normalize_label = None
+        self.cache_report = opt.get('metrics_cache_report', False)
 
     def __enter__(self):
         return self
@@ -92,20 +139,29 @@ class Metrics(object):
     def __repr__(self):
         return repr(self.metrics)
 
-    def _lock(self):
-        if hasattr(self.metrics, 'get_lock'):
-            # use the shared_table's lock
-            return self.metrics.get_lock()
+    def _add(self, key, value):
+        if hasattr(self.metrics, 'add'):
+            # lock-free add to this process's row of the shared counters
+            self.metrics.add(key, value)
         else:
-            # otherwise do nothing
-            return self
+            self.metrics[key] += value
 
-    def update_ranking_metrics(self, observation, labels, label_cands):
+    def _totals(self):
+        if hasattr(self.metrics, 'totals'):
+            # sum the rows of all processes once
+            return self.metrics.totals()
+        else:
+            return self.metrics
+
+    def _hits(self, observation, labels):
+        """Returns the list of k in eval_pr for which one of the top k text
+        candidates (or the text) is a label.
+        """
         text_cands = observation.get('text_candidates', None)
         if text_cands is None:
             text = observation.get('text', None)
             if text is None:
-                return
+                return []
             else:
                 text_cands = [ text ]
         # Now loop through text candidates, assuming they are sorted.
@@ -123,53 +179,81 @@ class Metrics(object):
         # hits metric is 1 if cnts[k] > 0.
         # (other metrics such as p@k and r@k take
         # the value of cnt into account.)
-        with self._lock():
-            for k in self.eval_pr:
-                if cnts[k] > 0:
-                    self.metrics['hits@' + str(k)] += 1
+        return [k for k in self.eval_pr if cnts[k] > 0]
 
+    def update_ranking_metrics(self, observation, labels, label_cands):
+        for k in self._hits(observation, labels):
+            self._add('hits@' + str(k), 1)
 
     def update(self, observation, labels, label_cands):
-        with self._lock():
-            self.metrics['cnt'] += 1
+        # Return a dict containing the metrics for this specific example.
+        # Metrics across all data is stored internally in the class, and
+        # can be accessed with the report method.
+        return self.batch_update([observation], [labels], [label_cands])[0]
 
-        # Exact match metric.
-        correct = 0
-        prediction = observation.get('text', None)
-        if _exact_match(prediction, labels):
-            correct = 1
-        with self._lock():
-            self.metrics['correct'] += correct
+    def batch_update(self, observations, labels_list, cands_list):
+        """Scores a batch of observations against their labels in one pass.
+        Each distinct label is normalized at most once per batch (or looked
+        up in the label cache), and the shared counters are updated once for
+        the whole batch.
+        Returns a list with a dict of the metrics for each example.
+        """
+        if self._normalize_label is not None:
+            normalize = self._normalize_label
+        else:
+            normalized = {}
 
-        # F1 metric.
-        f1 = _f1_score(prediction, labels)
-        with self._lock():
-            self.metrics['f1'] += f1
+            def normalize(answer):
+                if answer not in normalized:
+                    normalized[answer] = _normalize_tokens(answer)
+                return normalized[answer]
 
-        # Ranking metrics.
-        self.update_ranking_metrics(observation, labels, label_cands)
+        totals = {k: 0 for k in self.metrics}
+        losses = []
+        for observation, labels in zip(observations, labels_list):
+            totals['cnt'] += 1
 
-        # Return a dict containing the metrics for this specific example.
-        # Metrics across all data is stored internally in the class, and
-        # can be accessed with the report method.
-        loss = {}
-        loss['correct'] = correct
-        return loss
+            # Exact match and F1 metrics.
+            prediction = observation.get('text', None)
+            correct, f1 = _score_answers(prediction, labels, normalize)
+            totals['correct'] += correct
+            totals['f1'] += f1
+
+            # Ranking metrics.
+            for k in self._hits(observation, labels):
+                totals['hits@' + str(k)] += 1
+
+            loss = {}
+            loss['correct'] = correct
+            losses.append(loss)
+
+        for k, v in totals.items():
+            if v:
+                self._add(k, v)
+        return losses
 
     def report(self):
         # Report the metrics over all data seen so far.
+        metrics = self._totals()
         m = {}
-        m['total'] = self.metrics['cnt']
-        if self.metrics['cnt'] > 0:
-            m['accuracy'] = self.metrics['correct'] / self.metrics['cnt']
-            m['f1'] = self.metrics['f1'] / self.metrics['cnt']
+        m['total'] = int(metrics['cnt'])
+        if metrics['cnt'] > 0:
+            m['accuracy'] = metrics['correct'] / metrics['cnt']
+            m['f1'] = metrics['f1'] / metrics['cnt']
             m['hits@k'] = {}
             for k in self.eval_pr:
-                m['hits@k'][k] = self.metrics['hits@' + str(k)] / self.metrics['cnt']
+                m['hits@k'][k] = metrics['hits@' + str(k)] / metrics['cnt']
+        if self.cache_report and self._normalize_label is not None:
+            info = self._normalize_label.cache_info()
+            m['label_cache'] = {'hits': info.hits, 'misses': info.misses,
+                                'size': info.currsize}
         return m
 
     def clear(self):
-        with self._lock():
+        if hasattr(self.metrics, 'totals'):
+            # zero the rows of all processes
+            self.metrics.clear()
+        else:
             self.metrics['cnt'] = 0
             self.metrics['correct'] = 0
             self.metrics['f1'] = 0.0
@@ -78,9 +78,38 @@ class ParlaiParser(object):
         self.parser.add_argument(
             '-nt', '--numthreads', default=1, type=int,
             help='number of threads, e.g. for hogwild')
+        self.parser.add_argument(
+            '--parallel-eval', default=False, type='bool',
+            help='when numthreads > 1 and batchsize is 1, split each pass ' +
+                 'over valid or test data between numthreads processes ' +
+                 '(for teachers which shard their data, like ' +
+                 'DialogTeacher). each parley then runs one example in ' +
+                 'every process')
         self.parser.add_argument(
             '-bs', '--batchsize', default=1, type=int,
             help='batch size for minibatch training schemes')
+        self.parser.add_argument(
+            '--datafile-cache', default=False, type='bool',
+            help='cache fixed datasets in a preprocessed binary file next to ' +
+                 'their datafile, so that later runs skip parsing the text')
+        self.parser.add_argument(
+            '--dialog-data', choices=['memory', 'mmap'],
+            help='storage for fixed dialog datasets: memory keeps python ' +
+                 'objects, mmap keeps a memory-mapped array-backed copy on ' +
+                 'disk (for very large datasets). defaults to mmap for ' +
+                 'hogwild training (numthreads > 1) and --parallel-eval, so ' +
+                 'that processes share the same pages, and to memory ' +
+                 'otherwise')
+        self.parser.add_argument(
+            '--metrics-cache-size', default=10000, type=int,
+            help='number of normalized labels to keep in the lru cache used ' +
+                 'when computing metrics, 0 to disable the cache')
+        self.parser.add_argument(
+            '--metrics-cache-report', default=False, type='bool',
+            help='include the hits and misses of the label cache in the ' +
+                 'metrics reports, for debugging. they are counted in each ' +
+                 'process separately, so only cover the main process when ' +
+                 'numthreads > 1')
         self.add_parlai_data_path()
 
     def add_model_args(self):
@@ -13,7 +13,10 @@ except ImportError:
     # python2
     from collections import MutableMapping
 import ctypes
+import numpy as np
+import os
 import sys
+import weakref
 
 class SharedTable(MutableMapping):
     """Provides a simple shared-memory table of integers, floats, or strings.
@@ -146,3 +149,119 @@ class SharedTable(MutableMapping):
 
     def get_lock(self):
         return self.lock
+
+
+class SharedCounters(object):
+    """Provides a table of float counters in shared memory which any number of
+    processes can add to without taking a lock.
+    Use this class as follows:
+
+    cnts = SharedCounters(['cnt', 'correct'], num_procs=4)
+    cnts.add('cnt', 1)  # in any process
+    cnts['cnt']  # total over all processes
+
+    The counters are stored in a (num_procs x len(keys)) array. The first
+    time a process adds to the table it claims its own row (this takes the
+    lock once), and from then on it only writes to that row, so updates from
+    different processes never contend. Reading a counter sums its column.
+    A row stays claimed until it is released with release(pid), which keeps
+    its counts, so later processes can replace earlier ones. The worlds
+    which start processes release their rows (in every table) once they
+    have joined them, with SharedCounters.release_process(pid).
+    """
+
+    # the tables created in this process, for release_process
+    _tables = weakref.WeakSet()
+
+    def __init__(self, keys, num_procs):
+        self.keys = list(keys)
+        self.cols = {k: i for i, k in enumerate(self.keys)}
+        self.num_procs = num_procs
+        self.array = RawArray(ctypes.c_double, num_procs * len(self.keys))
+        # pid of the process owning each row, 0 if the row is free
+        self.owners = RawArray(ctypes.c_long, num_procs)
+        self.lock = Lock()
+        self._pid = None
+        self._row = None
+        SharedCounters._tables.add(self)
+
+    def _values(self):
+        """Returns a numpy view of the shared array (no copy)."""
+        return np.frombuffer(self.array, dtype=np.float64).reshape(
+            self.num_procs, len(self.keys))
+
+    def _my_row(self):
+        """Returns this process's row of the array, claiming one if needed."""
+        if self._pid != os.getpid():
+            with self.lock:
+                row = self._free_row()
+                self.owners[row] = os.getpid()
+            self._row = self._values()[row]
+            self._pid = os.getpid()
+        return self._row
+
+    def _free_row(self):
+        """Returns the first row which is not claimed."""
+        for row, pid in enumerate(self.owners):
+            if pid == 0:
+                return row
+        raise RuntimeError('SharedCounters was created for {} processes, ran '
+                           'out of rows.'.format(self.num_procs))
+
+    def release(self, pid=None):
+        """Frees the row of process pid (by default this one), keeping its
+        counts, so that another process can claim it. The process must not
+        add to the table afterwards.
+        """
+        pid = os.getpid() if pid is None else pid
+        with self.lock:
+            for row, owner in enumerate(self.owners):
+                if owner == pid:
+                    self.owners[row] = 0
+        if pid == self._pid:
+            self._pid = None
+            self._row = None
+
+    @classmethod
+    def release_process(cls, pid):
+        """Releases the rows of process pid in every table created in this
+        process, e.g. after joining a child process which used them.
+        """
+        for table in list(cls._tables):
+            table.release(pid)
+
+    def add(self, key, value=1):
+        """Adds value to this process's copy of the counter. No locking."""
+        self._my_row()[self.cols[key]] += value
+
+    def __getitem__(self, key):
+        """Returns the counter summed over all processes."""
+        return float(self._values()[:, self.cols[key]].sum())
+
+    def __contains__(self, key):
+        return key in self.cols
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def totals(self):
+        """Returns a dict with every counter summed over all processes."""
+        sums = self._values().sum(axis=0)
+        return {k: float(sums[i]) for i, k in enumerate(self.keys)}
+
+    def clear(self):
+        """Sets every counter to zero in every row."""
+        self._values().fill(0)
+
+    def __str__(self):
+        return str(self.totals())
+
+    def __repr__(self):
+        representation = super().__repr__()
+        return representation.replace('>', ': {}>'.format(str(self)))
+
+    def get_lock(self):
+        return self.lock
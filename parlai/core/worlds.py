@@ -24,6 +24,10 @@ HogwildWorld(World) is a container that creates another world within itself for
 BatchWorld(World) is a container for doing minibatch training over a world by
 collecting batches of N copies of the environment (each with different state).
 
+ParallelEvalWorld(World) is a container that splits one pass over ordered
+    (valid or test) data between several processes, each with its own world
+    built from shared agents, and reports the combined metrics.
+
 
 All worlds are initialized with the following parameters:
 opt -- contains any options needed to set up the agent. This generally contains
@@ -43,9 +47,11 @@ import copy
 import importlib
 import random
 
-from multiprocessing import Process, Value, Condition, Semaphore
+from multiprocessing import Array, Process, Value, Condition, Semaphore
 from collections import deque
 from parlai.core.agents import _create_task_agents, create_agents_from_shared
+from parlai.core.agents import get_task_teacher_class
+from parlai.core.thread_utils import SharedCounters
 from parlai.tasks.tasks import ids_to_tasks
 
 def validate(observation):
@@ -190,6 +196,30 @@ class World(object):
         pass
 
 
+def _teachers_shard(opt):
+    """Returns whether the teacher of every task in opt['task'] can split its
+    data between several copies of itself (see DialogTeacher.shard).
+    """
+    return all(hasattr(get_task_teacher_class(dict(opt, task=task)), 'shard')
+               for task in opt['task'].split(','))
+
+
+def _override_shared_opt(shared, **overrides):
+    """Copies the share dict of a world or agent, including the shared agents
+    and worlds it contains, with overrides set in each of their opts. This is
+    used to tell the teachers created from it which shard of the ordered data
+    they should visit (see DialogTeacher.shard()).
+    """
+    shared = dict(shared)
+    if shared.get('opt') is not None:
+        shared['opt'] = dict(shared['opt'], **overrides)
+    for key in ('agents', 'worlds'):
+        if shared.get(key) is not None:
+            shared[key] = [_override_shared_opt(s, **overrides)
+                           for s in shared[key]]
+    return shared
+
+
 class DialogPartnerWorld(World):
     """This basic world switches back and forth between two agents, giving each
     agent one chance to speak per turn and passing that back to the other agent.
@@ -412,22 +442,33 @@ class BatchWorld(World):
     the parameters for each.
     The underlying world(s) it is batching can be either DialogPartnerWorld,
     MultiAgentWorld or MultiWorld.
+
+    Ordered data is only supported when the teacher of every task can shard
+    its data (otherwise each world would go over all of it). Then the
+    teachers of each world visit a different shard of the episodes, and only the worlds which have not finished their epoch yet take
+    part in a parley. The batches given to batch_act() are still padded to
+    batchsize rows, with an empty observation in the slot of each finished
+    world, and the replies for those slots are dropped. The epoch is done
+    once every world is done, after exactly one pass over the data.
     """
 
     def __init__(self, opt, world):
         self.opt = opt
         self.random = opt.get('datatype', None) == 'train'
-        if not self.random:
+        if not self.random and not _teachers_shard(opt):
             raise NotImplementedError(
-                'Ordered data not implemented yet in batch mode.')
-
+                'Ordered data in batch mode is only implemented for teachers '
+                'which shard their data, like DialogTeacher.')
         self.world = world
         shared = world.share()
         self.worlds = []
         for i in range(opt['batchsize']):
             opti = copy.deepcopy(opt)
             opti['batchindex'] = i
-            self.worlds.append(shared['world_class'](opti, None, shared))
+            sharedi = _override_shared_opt(shared, batchindex=i,
+                                           batchsize=opt['batchsize'])
+            self.worlds.append(shared['world_class'](opti, None, sharedi))
+        self.active = list(range(len(self.worlds)))
         self.batch_observations = [ None ] * len(self.worlds)
 
     def __iter__(self):
@@ -438,39 +479,75 @@ class BatchWorld(World):
             raise StopIteration()
 
     def batch_observe(self, index, batch):
-        for w in self.worlds:
-            agents = w.get_agents()
-            agents[index].observe(validate(batch[index]))
+        # Teachers which support it leave scoring to us, so that each set of
+        # shared metrics is updated once per batch rather than per example.
+        to_score = {}
+        for i, w in enumerate(self.active_worlds()):
+            agent = w.get_agents()[index]
+            observation = validate(batch[i])
+            if hasattr(agent, 'observe_unscored'):
+                labels, label_cands = agent.observe_unscored(observation)
+                if labels is not None:
+                    metrics = agent.metrics
+                    if id(metrics) not in to_score:
+                        to_score[id(metrics)] = (metrics, [], [], [])
+                    group = to_score[id(metrics)]
+                    group[1].append(observation)
+                    group[2].append(labels)
+                    group[3].append(label_cands)
+            else:
+                agent.observe(observation)
+        for metrics, observations, labels, label_cands in to_score.values():
+            metrics.batch_update(observations, labels, label_cands)
         return batch
 
     def batch_act(self, index, batch_observation):
         # Given batch observation, do update for agents[index].
         # Call update on agent
         a = self.world.get_agents()[index]
-        if (batch_observation is not None and len(batch_observation) > 0 and
+        worlds = self.active_worlds()
+        if (batch_observation is not None and
+            len(batch_observation) == len(worlds) and
             hasattr(a, 'batch_act')):
-            batch_reply = a.batch_act(batch_observation)
+            # pad the slots of finished worlds with empty observations, so
+            # that the batch always has batchsize rows
+            padded = [{} for _ in self.worlds]
+            for i, observation in zip(self.active, batch_observation):
+                padded[i] = observation
+            batch_reply = a.batch_act(padded)
+            batch_reply = [batch_reply[i] for i in self.active]
             # Store the actions locally in each world.
-            for w in self.worlds:
+            for i, w in enumerate(worlds):
                 acts = w.get_acts()
-                acts[index] = batch_reply[index]
+                acts[index] = batch_reply[i]
         else:
             # Reverts to running on each individually.
             batch_reply = []
-            for w in self.worlds:
+            for w in worlds:
                 agents = w.get_agents()
                 acts = w.get_acts()
                 acts[index] = agents[index].act()
                 batch_reply.append(acts[index])    
         return batch_reply
 
+    def active_worlds(self):
+        """Returns the worlds taking part in the current parley."""
+        return [self.worlds[i] for i in self.active]
+
     def parley(self):
         # Collect batch together for each agent, and do update.
         # Assumes DialogPartnerWorld, MultiAgentWorld, or MultiWorlds of them.
         num_agents = len(self.world.get_agents())
         batch_observations = self.batch_observations
 
-        for w in self.worlds:
+        if not self.random:
+            # worlds which finished their shard of the data sit out
+            self.active = [i for i, w in enumerate(self.worlds)
+                           if not w.epoch_done()]
+            if not self.active:
+                return
+
+        for w in self.active_worlds():
             if hasattr(w, 'parley_init'):
                 w.parley_init()
         
@@ -483,11 +560,9 @@ class BatchWorld(World):
 
     def display(self):
         s = ("[--batchsize " + str(len(self.worlds)) + "--]\n")
-        for i, w in enumerate(self.worlds):
+        for i in self.active:
             s += ("[batch world " + str(i) + ":]\n")
-            s += (w.display() + '\n')
-            if not self.random and w.epoch_done():
-                break
+            s += (self.worlds[i].display() + '\n')
         s += ("[--end of batch--]")
         return s
 
@@ -498,10 +573,15 @@ class BatchWorld(World):
         return False
 
     def epoch_done(self):
+        if self.random:
+            for world in self.worlds:
+                if world.epoch_done():
+                    return True
+            return False
         for world in self.worlds:
-            if world.epoch_done():
-                return True
-        return False
+            if not world.epoch_done():
+                return False
+        return True
 
     def report(self):
         return self.worlds[0].report()
@@ -612,10 +692,171 @@ class HogwildWorld(World):
         # wake up each thread by queueing fake examples
         for _ in self.threads:
             self.queued_items.release()
-        # wait for threads to close
+        # wait for threads to close, then free their rows of shared counters
         for t in self.threads:
             t.join()
+            SharedCounters.release_process(t.pid)
+
+
+
+class ParallelEvalProcess(Process):
+    """Process child used for ParallelEvalWorld.
+    Each ParallelEvalProcess runs its own World over its shard of the data,
+    one parley each time its semaphore is released, until the end of the
+    epoch.
+    """
+
+    def __init__(self, tid, world, opt, agent_shares, sem, fin, term, cnt,
+                 done):
+        self.threadId = tid
+        self.world_type = world
+        self.opt = dict(opt, threadindex=tid)
+        self.agent_shares = [_override_shared_opt(s, threadindex=tid)
+                             for s in agent_shares]
+        self.queued_items = sem
+        self.roundDone = fin
+        self.terminate = term
+        self.cnt = cnt
+        self.done = done
+        super().__init__()
+
+    def run(self):
+        shared_agents = create_agents_from_shared(self.agent_shares)
+        world = self.world_type(self.opt, shared_agents)
+
+        with world:
+            while True:
+                self.queued_items.acquire()
+                if self.terminate.value:
+                    break  # time to close
+                if not world.epoch_done():
+                    world.parley()
+                self.done[self.threadId] = world.epoch_done()
+                with self.cnt.get_lock():
+                    self.cnt.value -= 1
+                    if self.cnt.value == 0:
+                        # let the main process know that the round is over
+                        with self.roundDone:
+                            self.roundDone.notify_all()
+
+
+class ParallelEvalWorld(World):
+    """Evaluates over ordered data using a separate world for each thread
+    (process), each world seeing a different shard of the episodes.
+
+    The teacher must split its data by opt['threadindex'] (as DialogTeacher
+    does, see DialogTeacher.shard()) and share its metrics, so that together
+    the processes see every example exactly once and report() gives the same
+    metrics as a single-threaded pass.
+
+    Each call to parley() runs one parley in every process which has not
+    finished its shard yet, like a BatchWorld with one process per item of
+    the batch. The processes are started by the first parley, and stopped by
+    reset() or shutdown().
+    """
 
+    def __init__(self, world_class, opt, agents):
+        super().__init__(opt)
+        self.inner_world = world_class(opt, agents)
+        self.world_class = world_class
+        self.numthreads = opt['numthreads']
+        self.threads = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.epoch_done():
+            raise StopIteration()
+
+    def display(self):
+        # the examples are seen by the worlds of the other processes
+        return ''
+
+    def _start(self):
+        self.queued_items = [Semaphore(0) for _ in range(self.numthreads)]
+        self.roundDone = Condition()
+        self.terminate = Value('b', False)
+        self.cnt = Value('i', 0)
+        self.done = Array('b', self.numthreads)
+        agent_shares = [a.share() for a in self.inner_world.get_agents()]
+        self.threads = [
+            ParallelEvalProcess(i, self.world_class, self.opt, agent_shares,
+                                self.queued_items[i], self.roundDone,
+                                self.terminate, self.cnt, self.done)
+            for i in range(self.numthreads)]
+        for t in self.threads:
+            t.start()
+
+    def _check_threads(self):
+        failed = [t.threadId for t in self.threads if not t.is_alive()]
+        if failed:
+            self._stop()
+            raise RuntimeError('parallel evaluation failed in thread(s) ' +
+                               ', '.join(str(tid) for tid in failed))
+
+    def parley(self):
+        """Runs one parley in each process which is not done yet, and waits
+        for all of them to finish it.
+        """
+        if not self.threads:
+            self._start()
+        active = [i for i in range(self.numthreads) if not self.done[i]]
+        if not active:
+            return
+        with self.cnt.get_lock():
+            self.cnt.value += len(active)
+        for i in active:
+            self.queued_items[i].release()
+        with self.roundDone:
+            while not self.roundDone.wait_for(lambda: self.cnt.value == 0,
+                                              timeout=1):
+                self._check_threads()
+
+    def episode_done(self):
+        return self.epoch_done()
+
+    def epoch_done(self):
+        return (len(self.threads) > 0 and
+                all(self.done[i] for i in range(self.numthreads)))
+
+    def getID(self):
+        return self.inner_world.getID()
+
+    def get_agents(self):
+        return self.inner_world.get_agents()
+
+    def report(self):
+        return self.inner_world.report()
+
+    def __len__(self):
+        return len(self.inner_world)
+
+    def _stop(self):
+        """Set shutdown flag and wake threads up to close themselves"""
+        if not self.threads:
+            return
+        with self.terminate.get_lock():
+            self.terminate.value = True
+        for sem in self.queued_items:
+            sem.release()
+        for t in self.threads:
+            t.join()
+            SharedCounters.release_process(t.pid)
+        self.threads = []
+
+    def reset(self):
+        """Stops the processes and resets the agents (and so the shared
+        metrics), so that the next parley starts a new pass over the data.
+        """
+        self._stop()
+        for a in self.inner_world.get_agents():
+            if hasattr(a, 'reset'):
+                a.reset()
+
+    def shutdown(self):
+        self._stop()
+        self.inner_world.shutdown()
 
 
 ### Functions for creating tasks/worlds given options.
@@ -667,6 +908,14 @@ def create_task(opt, user_agents):
     # Single threaded or hogwild task creation (the latter creates multiple threads).
     # Check datatype for train, because we need to do single-threaded for
     # valid and test in order to guarantee exactly one epoch of training.
+    # With --parallel-eval, teachers which can split their data between
+    # threads are instead evaluated in parallel, each process going over its
+    # own shard once.
+    if (opt.get('parallel_eval') and opt.get('numthreads', 1) > 1 and
+            opt['datatype'] != 'train' and opt.get('batchsize', 1) == 1 and
+            ',' not in opt['task'] and _teachers_shard(opt)):
+        world_class, task_agents = _get_task_world(opt)
+        return ParallelEvalWorld(world_class, opt, task_agents + user_agents)
     if opt.get('numthreads', 1) == 1 or opt['datatype'] != 'train':
         if ',' not in opt['task']:
             # Single task
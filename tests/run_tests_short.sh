@@ -8,4 +8,8 @@
 
 python test_import.py
 python test_dict.py
+python test_dialog.py
+python test_metrics.py
 python test_threadutils.py
+python test_drqa_pipeline.py
+python test_drqa.py
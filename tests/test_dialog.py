@@ -0,0 +1,288 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.core.agents import Teacher
+from parlai.core.dialog_teacher import DialogData, MmapDialogData
+from parlai.core.fbdialog_teacher import FbDialogTeacher
+from parlai.core.worlds import BatchWorld, DialogPartnerWorld
+from parlai.core.worlds import ParallelEvalWorld, create_task
+from parlai.agents.repeat_label.agents import RepeatLabelAgent
+from multiprocessing import Process, Value
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+TASK = 'parlai.core.fbdialog_teacher:FbDialogTeacher'
+FBDIALOG = """1 Sam went to the kitchen.
+2 Pat gave Sam the milk.
+3 Where is the milk?\tkitchen\t1\thallway|kitchen|bathroom
+4 Sam went to the hallway.
+5 Where is Sam?\thallway\t1\thallway|kitchen|bathroom
+1 Pat went to the bathroom.
+2 Where is Pat?\tbathroom\t1\thallway|kitchen|bathroom
+"""
+
+
+class BatchRepeatLabelAgent(RepeatLabelAgent):
+    """Records which rows of each batch hold an example."""
+
+    def __init__(self, opt, shared=None):
+        super().__init__(opt, shared)
+        self.batches = []
+
+    def batch_act(self, observations):
+        self.batches.append(['text' in obs for obs in observations])
+        return [{'id': self.getID(), 'text': obs.get('text', '')}
+                for obs in observations]
+
+
+class TestDialogTeacher(unittest.TestCase):
+    """Tests on DialogTeacher / DialogData using a small fbdialog file."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, 'data.txt')
+        with open(self.datafile, 'w') as write:
+            write.write(FBDIALOG)
+        self.opt = {'datatype': 'valid', 'datafile': self.datafile}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _examples(self, teacher):
+        examples = []
+        while not teacher.epoch_done():
+            examples.append(teacher.act())
+        return examples
+
+    def test_datafile_cache(self):
+        """Is the data cached after the first run and then reused?"""
+        expected = self._examples(FbDialogTeacher(self.opt))
+        self.assertEqual(len(expected), 3)
+
+        self.opt['datafile_cache'] = True
+        first = FbDialogTeacher(self.opt)
+        cache_files = [f for f in os.listdir(self.tmpdir)
+                       if f.endswith('.cache')]
+        self.assertEqual(len(cache_files), 1)
+        self.assertEqual(self._examples(first), expected)
+
+        # setup_data is not called when the cache is valid
+        second = FbDialogTeacher.__new__(FbDialogTeacher)
+        second.setup_data = None
+        FbDialogTeacher.__init__(second, self.opt)
+        self.assertEqual(self._examples(second), expected)
+
+        # changing the datafile invalidates the cache
+        with open(self.datafile, 'a') as write:
+            write.write('1 Who is there?\tnobody\n')
+        third = FbDialogTeacher(self.opt)
+        self.assertEqual(len(self._examples(third)), 4)
+        # and the cache of the old file is removed, for both backends
+        cache_files = [f for f in os.listdir(self.tmpdir)
+                       if f.endswith('.cache')]
+        self.assertEqual(len(cache_files), 1)
+        self.opt['dialog_data'] = 'mmap'
+        for line in ['1 Who was there?\tnobody\n', '1 And now?\tnobody\n']:
+            with open(self.datafile, 'a') as write:
+                write.write(line)
+            FbDialogTeacher(self.opt)
+        cache_dirs = [f for f in os.listdir(self.tmpdir)
+                      if f.endswith('.cache.d')]
+        self.assertEqual(len(cache_dirs), 1)
+        self.assertEqual(len([f for f in os.listdir(self.tmpdir)
+                              if f.endswith('.cache')]), 1)
+
+    def test_shards(self):
+        """Do the shards of the ordered data cover it exactly once?"""
+        expected = self._examples(FbDialogTeacher(self.opt))
+        for numthreads in [2, 3]:
+            self.opt['numthreads'] = numthreads
+            found = []
+            for index in range(numthreads):
+                self.opt['threadindex'] = index
+                found.extend(self._examples(FbDialogTeacher(self.opt)))
+            self.assertEqual(sorted(found, key=str), sorted(expected, key=str))
+
+    def test_parallel_eval(self):
+        """Does parallel evaluation report the same metrics?"""
+        # the labels are only shown to the agent on train data
+        opt = dict(self.opt, task=TASK, datatype='train:ordered')
+        teacher = FbDialogTeacher(opt)
+        world = DialogPartnerWorld(opt, [teacher, RepeatLabelAgent(opt)])
+        while not world.epoch_done():
+            world.parley()
+        expected = world.report()
+        self.assertEqual(expected['accuracy'], 1)
+
+        for numthreads in [2, 4]:
+            opt['numthreads'] = numthreads
+            teacher = FbDialogTeacher(opt)
+            with ParallelEvalWorld(DialogPartnerWorld, opt,
+                                   [teacher, RepeatLabelAgent(opt)]) as world:
+                parleys = 0
+                for _ in world:
+                    world.parley()
+                    self.assertEqual(world.display(), '')
+                    parleys += 1
+                # each parley runs one example in every process: the first
+                # episode, of two examples, takes the longest
+                self.assertEqual(parleys, 2)
+                self.assertEqual(world.report(), expected)
+
+                # after a reset, a parley starts a new pass
+                world.reset()
+                self.assertFalse(world.epoch_done())
+                world.parley()
+                self.assertEqual(world.report()['total'], 2)
+
+    def test_create_parallel_eval(self):
+        """Is parallel evaluation only used when asked for?"""
+        opt = dict(self.opt, numthreads=2, batchsize=1, task=TASK)
+        world = create_task(opt, RepeatLabelAgent(opt))
+        self.assertIsInstance(world, DialogPartnerWorld)
+        opt['parallel_eval'] = True
+        world = create_task(opt, RepeatLabelAgent(opt))
+        self.assertIsInstance(world, ParallelEvalWorld)
+        world.shutdown()
+
+    def test_batch_ordered(self):
+        """Does a batch over ordered data stop after exactly one pass?"""
+        opt = dict(self.opt, task=TASK, datatype='train:ordered')
+        teacher = FbDialogTeacher(opt)
+        world = DialogPartnerWorld(opt, [teacher, RepeatLabelAgent(opt)])
+        while not world.epoch_done():
+            world.parley()
+        expected = world.report()
+
+        for batchsize in [2, 4]:
+            opt['batchsize'] = batchsize
+            teacher = FbDialogTeacher(opt)
+            world = DialogPartnerWorld(opt, [teacher, RepeatLabelAgent(opt)])
+            batch_world = BatchWorld(opt, world)
+            sizes = []
+            for _ in batch_world:
+                batch_world.parley()
+                sizes.append(len(batch_world.active))
+            # two episodes: one of two examples and one of one example
+            self.assertEqual(sizes, [2, 1])
+            report = batch_world.report()
+            self.assertEqual(report, expected)
+
+    def test_batch_ordered_no_shard(self):
+        """Is batching ordered data refused for teachers which cannot shard
+        it (each world would go over all of it)?
+        """
+        opt = dict(self.opt, task='parlai.core.agents:Teacher', batchsize=4)
+        world = DialogPartnerWorld(opt, [Teacher(opt), RepeatLabelAgent(opt)])
+        with self.assertRaises(NotImplementedError):
+            BatchWorld(opt, world)
+        opt['datatype'] = 'train'
+        world = DialogPartnerWorld(opt, [Teacher(opt), RepeatLabelAgent(opt)])
+        self.assertEqual(len(BatchWorld(opt, world).worlds), 4)
+
+    def test_batch_padding(self):
+        """Is the last batch over ordered data padded to batchsize?"""
+        opt = dict(self.opt, task=TASK, datatype='valid', batchsize=3)
+        teacher = FbDialogTeacher(opt)
+        agent = BatchRepeatLabelAgent(opt)
+        world = BatchWorld(opt, DialogPartnerWorld(opt, [teacher, agent]))
+        for _ in world:
+            world.parley()
+        # shard 0 has an episode of two examples, shard 1 one example, and
+        # shard 2 is empty
+        self.assertEqual(agent.batches, [[True, True, False],
+                                         [True, False, False]])
+        self.assertEqual(world.report()['total'], 3)
+
+    def test_mmap_data(self):
+        """Does the memory-mapped backend return the same entries?"""
+        teacher = FbDialogTeacher(self.opt)
+        loader = [
+            (['x1', ['y1'], '1', ['y1', 'y2']], True),
+            (['x2', ['y2'], None, None], False),
+            (['x3', ['y3', 'y1'], '0'], True),
+            (['x4', None], True),
+            (['x5'], True),
+        ]
+        same = ['a', 'b']
+        loader.append((['x6', ['a'], None, same], True))
+        loader.append((['x7', ['a'], None, same], False))
+        for cands in [None, ['y1', 'y2', 'y3']]:
+            for source in [loader, list(teacher.setup_data(self.datafile))]:
+                data = DialogData(source, cands=cands)
+                mmap_data = MmapDialogData(source, cands=cands)
+                self.assertEqual(len(data), len(mmap_data))
+                self.assertEqual(data.num_episodes(), mmap_data.num_episodes())
+                for i in range(data.num_episodes()):
+                    j = 0
+                    while True:
+                        entry = data.get(i, j)
+                        self.assertEqual(entry, mmap_data.get(i, j))
+                        if entry[0]['episode_done']:
+                            break
+                        j += 1
+
+                # negative indices count from the end
+                last = data.num_episodes() - 1
+                for d in [data, mmap_data]:
+                    self.assertEqual(d.get(-1), d.get(last))
+                    self.assertEqual(d.get(-2, -1),
+                                     d.get(last - 1,
+                                           d._episode_length(last - 1) - 1))
+                    self.assertRaises(IndexError, d.get, last + 1)
+                    self.assertRaises(IndexError, d.get, -last - 2)
+
+                # global entry index lookups agree with a scan
+                index = [(i, j) for i in range(data.num_episodes())
+                         for j in range(data._episode_length(i))]
+                self.assertEqual(len(index), len(data))
+                for k, pos in enumerate(index):
+                    self.assertEqual(data.locate(k), pos)
+                    self.assertEqual(mmap_data.locate(k), pos)
+                self.assertIn(data.random_entry(), index)
+                self.assertIn(mmap_data.random_entry(), index)
+
+                # reopening the directory gives the same data
+                reopened = MmapDialogData.load(mmap_data.path)
+                self.assertEqual(reopened.get(0, 0), mmap_data.get(0, 0))
+
+    def test_mmap_sharing(self):
+        """Do other processes attach to the same files?"""
+        self.opt['numthreads'] = 2
+        # single process evaluation keeps the data in memory
+        teacher = FbDialogTeacher(self.opt)
+        self.assertNotIsInstance(teacher.share()['data'], MmapDialogData)
+        self.opt['datatype'] = 'train'
+        teacher = FbDialogTeacher(self.opt)
+        data = teacher.share()['data']
+        self.assertIsInstance(data, MmapDialogData)
+        self.assertIsInstance(FbDialogTeacher(dict(
+            self.opt, datatype='valid', parallel_eval=True)).data,
+            MmapDialogData)
+
+        # pickling only sends the location of the data
+        copy = pickle.loads(pickle.dumps(data))
+        self.assertEqual(copy.path, data.path)
+        self.assertEqual(copy.get(1, 0), data.get(1, 0))
+        del copy
+        self.assertTrue(os.path.isdir(data.path))
+
+        found = Value('i', 0)
+
+        def read():
+            found.value = len(data) + data.num_episodes()
+
+        p = Process(target=read)
+        p.start()
+        p.join()
+        self.assertEqual(found.value, len(data) + data.num_episodes())
+        self.assertTrue(os.path.isdir(data.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
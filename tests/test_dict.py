@@ -3,7 +3,16 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
-from parlai.core.dict import find_ngrams
+from parlai.core.dict import find_ngrams, build_ngram_trie, FrozenDictionary
+from parlai.core.dict import DictionaryAgent, CountMinSketch
+from parlai.core.dict import build_dict_parallel
+from multiprocessing import Process, Value
+import numpy as np
+import os
+import pickle
+import random
+import shutil
+import tempfile
 import unittest
 
 
@@ -27,6 +36,60 @@ class TestDictionary(unittest.TestCase):
         assert ' '.join(res) == 'hello world buddy ol boy'
         assert '-'.join(res) == 'hello world buddy-ol boy'
 
+    def test_find_ngrams_trie(self):
+        """Does the trie find the same ngrams as scanning for each size?"""
+        def scan(token_dict, text, n):
+            # segments text by looking up every window of each size in turn
+            if n <= 1:
+                return text
+            saved, gap, i = [], 0, 0
+            while i + n <= len(text):
+                if ' '.join(text[i:i + n]) in token_dict:
+                    saved.extend(scan(token_dict, text[gap:i], n - 1))
+                    saved.append(' '.join(text[i:i + n]))
+                    i += n
+                    gap = i
+                else:
+                    i += 1
+            return saved + scan(token_dict, text[gap:], n - 1)
+
+        rng = random.Random(0)
+        words = ['a', 'b', 'c', 'd']
+        for _ in range(500):
+            s = set(' '.join(rng.choice(words)
+                             for _ in range(rng.randint(1, 4)))
+                    for _ in range(rng.randint(0, 10)))
+            text = [rng.choice(words) for _ in range(rng.randint(0, 12))]
+            n = rng.randint(1, 5)
+            trie = build_ngram_trie(s)
+            self.assertEqual(find_ngrams(s, text, n, trie), scan(s, text, n))
+
+        opt = {'dict_nulltoken': '<NULL>', 'dict_unktoken': '<UNK>',
+               'dict_tokenizer': 'split', 'dict_max_ngram_size': 3}
+        dictionary = DictionaryAgent(opt)
+        self.assertEqual(dictionary.tokenize('new york city'),
+                         ['new', 'york', 'city'])
+        dictionary['new york'] = 1
+        self.assertEqual(dictionary.tokenize('new york city'),
+                         ['new york', 'city'])
+        dictionary['york city'] = 1
+        dictionary['new york city'] = 1
+        self.assertEqual(dictionary.tokenize('in new york city'),
+                         ['in', 'new york city'])
+
+        # single words do not change the trie, and new ngrams are inserted
+        trie = dictionary.trie
+        dictionary.add_to_dict(['in', 'los', 'angeles'])
+        dictionary['los angeles'] = 1
+        self.assertEqual(dictionary.tokenize('in los angeles'),
+                         ['in', 'los angeles'])
+        self.assertIs(dictionary.trie, trie)
+        # removing ngrams rebuilds it
+        dictionary.remove_tail(2)
+        self.assertEqual(dictionary.tokenize('in new york'),
+                         ['in', 'new', 'york'])
+        self.assertIsNot(dictionary.trie, trie)
+
     def test_basic_parse(self):
         """Check that the dictionary is correctly adding and parsing short
         sentence.
@@ -59,6 +122,263 @@ class TestDictionary(unittest.TestCase):
         assert vec[0] == num_builtin
         assert vec[1] == num_builtin + 1
 
+    def test_tokenizers(self):
+        """Do the regex and split tokenizers find the expected tokens?"""
+        opt = {'dict_nulltoken': '<NULL>', 'dict_unktoken': '<UNK>'}
+        text = 'Hello, world! It costs 3.50|free'
+        opt['dict_tokenizer'] = 'regex'
+        dictionary = DictionaryAgent(opt)
+        self.assertEqual(list(dictionary.tokenize(text)),
+                         ['Hello', ',', 'world', '!', 'It', 'costs', '3.50',
+                          '__pipe__', 'free'])
+        self.assertEqual(list(dictionary.tokenize(text, building=True))[-2:],
+                         ['3.50', 'free'])
+        opt['dict_tokenizer'] = 'split'
+        dictionary = DictionaryAgent(opt)
+        self.assertEqual(list(dictionary.tokenize(text)),
+                         ['Hello,', 'world!', 'It', 'costs', '3.50',
+                          '__pipe__', 'free'])
+
+    def test_tokenize_cache(self):
+        """Are cached tokens reused, and still joined into new ngrams?"""
+        opt = {'dict_nulltoken': '<NULL>', 'dict_unktoken': '<UNK>',
+               'dict_tokenizer': 'regex', 'dict_max_ngram_size': 2}
+        self.assertIsNone(DictionaryAgent(opt).tokenize_cache_info())
+        opt['dict_cache_size'] = 2
+        dictionary = DictionaryAgent(opt)
+        tokens = dictionary.tokenize('new york|again')
+        self.assertEqual(tokens, ['new', 'york', '__pipe__', 'again'])
+        tokens.append('changed')
+        self.assertEqual(dictionary.tokenize('new york|again'),
+                         ['new', 'york', '__pipe__', 'again'])
+        self.assertEqual(dictionary.tokenize('new york|again', building=True),
+                         ['new', 'york', 'again'])
+        self.assertEqual(dictionary.tokenize_cache_info(),
+                         {'hits': 1, 'misses': 2, 'size': 2})
+
+        dictionary['new york'] = 1
+        self.assertEqual(dictionary.tokenize('new york|again'),
+                         ['new york', '__pipe__', 'again'])
+        dictionary.tokenize('other')
+        dictionary.tokenize('new york|again', building=True)
+        self.assertEqual(dictionary.tokenize_cache_info(),
+                         {'hits': 2, 'misses': 4, 'size': 2})
+
+        # the cache is not pickled, e.g. when a model saves the dictionary
+        copy = pickle.loads(pickle.dumps(dictionary))
+        self.assertEqual(copy.tokenize_cache_info(),
+                         {'hits': 0, 'misses': 0, 'size': 0})
+        self.assertEqual(copy.tokenize('new york'), ['new york'])
+        self.assertEqual(copy.tokenize_cache_info()['size'], 1)
+
+    def test_share(self):
+        """Are shared copies writable until the dictionary is frozen?"""
+        opt = {'dict_nulltoken': '<NULL>', 'dict_unktoken': '<UNK>',
+               'dict_tokenizer': 'split', 'dict_max_ngram_size': 2}
+        dictionary = DictionaryAgent(opt)
+        copy = DictionaryAgent(opt, dictionary.share())
+        copy.add_to_dict(['a', 'b', 'a'])
+        dictionary.add_to_dict(['b'])
+        self.assertEqual(dictionary.freq['a'], 2)
+        self.assertEqual(copy.freq['b'], 2)
+        self.assertEqual(copy.version, dictionary.version)
+        copy['new york'] = 1
+        self.assertEqual(dictionary.tokenize('in new york'),
+                         ['in', 'new york'])
+        dictionary.sort()
+        self.assertEqual(copy.ind2tok[2], 'a')
+        self.assertEqual(copy['b'], dictionary['b'])
+
+        frozen = dictionary.freeze()
+        shared = dictionary.share()
+        self.assertIs(shared['frozen'], frozen)
+        frozen_copy = DictionaryAgent(opt, shared)
+        self.assertEqual(frozen_copy['a'], dictionary['a'])
+        self.assertRaises(RuntimeError, frozen_copy.add_to_dict, ['c'])
+
+        # once changed, the dictionary shares its maps again
+        dictionary.add_to_dict(['c'])
+        self.assertNotIn('frozen', dictionary.share())
+
+    def test_batch_txt2vec(self):
+        """Are batches of strings padded, and converted back to strings?"""
+        opt = {'dict_nulltoken': '<NULL>', 'dict_unktoken': '<UNK>',
+               'dict_tokenizer': 'split'}
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict(['hello', 'world', 'again'])
+        texts = ['hello world', 'again', '', 'hello world again', 'again']
+        matrix, lengths = dictionary.batch_txt2vec(texts)
+        self.assertEqual(matrix.dtype, np.int32)
+        self.assertEqual(matrix.shape, (5, 3))
+        self.assertEqual(lengths.tolist(), [2, 1, 0, 3, 1])
+        for text, row, length in zip(texts, matrix, lengths):
+            self.assertEqual(row[:length].tolist(),
+                             dictionary.txt2vec(text, list))
+            self.assertTrue((row[length:] == dictionary['<NULL>']).all())
+        self.assertEqual(dictionary.batch_vec2txt(matrix, lengths), texts)
+
+        matrix, lengths = dictionary.batch_txt2vec(texts, max_len=2, pad=-1)
+        self.assertEqual(matrix.shape, (5, 2))
+        self.assertEqual(matrix[1].tolist(), [dictionary['again'], -1])
+        self.assertEqual(dictionary.batch_vec2txt(matrix, lengths)[3],
+                         'hello world')
+        self.assertEqual(dictionary.batch_vec2txt([[dictionary['hello']]]),
+                         ['hello'])
+
+        matrix, lengths = dictionary.batch_txt2vec([])
+        self.assertEqual(matrix.shape, (0, 0))
+
+    def test_build_dict_parallel(self):
+        """Is a dictionary built in parallel the same as a serial one?"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            datafile = os.path.join(tmpdir, 'data.txt')
+            with open(datafile, 'w') as write:
+                for i in range(20):
+                    write.write('1 word{} and more words {}?\tyes\n'.format(
+                                i % 7, i % 3))
+            opt = {'dict_nulltoken': '<NULL>', 'dict_unktoken': '<UNK>',
+                   'dict_tokenizer': 'regex', 'datafile': datafile,
+                   'task': 'parlai.core.fbdialog_teacher:FbDialogTeacher'}
+            dicts = []
+            for num_workers in [1, 3]:
+                dictionary = DictionaryAgent(opt)
+                build_dict_parallel(dictionary, opt, ['train:ordered'],
+                                    num_workers)
+                dictionary.sort()
+                dicts.append(dictionary)
+            self.assertEqual(dict(dicts[0].freq), dict(dicts[1].freq))
+            self.assertEqual(dict(dicts[0].tok2ind), dict(dicts[1].tok2ind))
+            self.assertEqual(dicts[0].freq['more'], 20)
+
+            # with a sketch (wide enough not to collide), only tokens seen at
+            # least minfreq times are kept, with the same counts
+            opt.update({'dict_minfreq': 5, 'dict_sketch_width': 4096})
+            for num_workers in [1, 3]:
+                dictionary = DictionaryAgent(opt)
+                build_dict_parallel(dictionary, opt, ['train:ordered'],
+                                    num_workers)
+                self.assertEqual(dict(dictionary.freq),
+                                 {tok: cnt for tok, cnt in dicts[0].freq.items()
+                                  if cnt >= 5})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_trim(self):
+        """Are rare tokens removed, and the rest reindexed?"""
+        opt = {'dict_nulltoken': '<NULL>', 'dict_unktoken': '<UNK>',
+               'dict_tokenizer': 'split'}
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict('c b a b c c d'.split())
+        dictionary.remove_tail(2)
+        self.assertEqual(dict(dictionary.tok2ind),
+                         {'<NULL>': 0, '<UNK>': 1, 'c': 2, 'b': 3})
+        self.assertEqual(dictionary.ind2tok[3], 'b')
+        self.assertNotIn('a', dictionary.freq)
+
+        opt['dict_minfreq'] = 2
+        opt['dict_maxtokens'] = 3
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict('a b a b c c c d'.split())
+        self.assertEqual(dictionary.sort(), [('<NULL>', 1000000001),
+                                             ('<UNK>', 1000000000),
+                                             ('c', 3)])
+        self.assertEqual(dict(dictionary.ind2tok),
+                         {0: '<NULL>', 1: '<UNK>', 2: 'c'})
+        self.assertEqual(dictionary.txt2vec('c a', list), [2, 1])
+
+        opt['dict_maxtokens'] = 1
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict('a a'.split())
+        dictionary.sort()
+        self.assertEqual(dict(dictionary.tok2ind), {'<NULL>': 0, '<UNK>': 1})
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict('a a'.split())
+        dictionary.sort(trim=False)
+        self.assertEqual(len(dictionary), 3)
+
+    def test_sketch(self):
+        """Are tokens only kept once their sketched count reaches minfreq?"""
+        sketch = CountMinSketch(64, 3)
+        self.assertEqual(sketch.add(['a', 'b', 'a']).tolist(), [2, 1, 2])
+        self.assertTrue((sketch.estimate(['a', 'b', 'zzz']) >=
+                         [2, 1, 0]).all())
+
+        opt = {'dict_nulltoken': '<NULL>', 'dict_unktoken': '<UNK>',
+               'dict_tokenizer': 'split', 'dict_minfreq': 3,
+               'dict_sketch_width': 1024}
+        dictionary = DictionaryAgent(opt)
+        dictionary.add_to_dict('a b a'.split())
+        self.assertNotIn('a', dictionary.tok2ind)
+        dictionary.add_to_dict('a a b c'.split())
+        self.assertEqual(dictionary.freq['a'], 4)
+        self.assertNotIn('b', dictionary.tok2ind)
+        dictionary.add_to_dict(['a'])
+        self.assertEqual(dictionary.freq['a'], 5)
+
+
+class TestFrozenDictionary(unittest.TestCase):
+    """Tests on the compact read-only dictionary used for sharing."""
+
+    tokens = ['<NULL>', '<UNK>', 'the', 'b', 'a', 'caf\u00e9', 'zebra', '']
+    freqs = [10, 9, 5, 4, 4, 2, 1, 0]
+
+    def check(self, frozen):
+        self.assertEqual(len(frozen), len(self.tokens))
+        for i, tok in enumerate(self.tokens):
+            self.assertEqual(frozen.tok2ind[tok], i)
+            self.assertEqual(frozen.ind2tok[i], tok)
+            self.assertEqual(frozen.freq[tok], self.freqs[i])
+        self.assertEqual(list(frozen.tok2ind), self.tokens)
+        self.assertNotIn('cafe', frozen.tok2ind)
+        self.assertNotIn('zzz', frozen.tok2ind)
+        self.assertNotIn(len(self.tokens), frozen.ind2tok)
+        self.assertEqual(frozen.ind2tok.get(-1, '<UNK>'), '<UNK>')
+        self.assertEqual(frozen.tok2ind.get('new', 1), 1)
+
+    def test_lookup(self):
+        """Are tokens, indices and frequencies found in both directions?"""
+        self.check(FrozenDictionary(self.tokens, self.freqs))
+        empty = FrozenDictionary([], [])
+        self.assertEqual(len(empty), 0)
+        self.assertNotIn('a', empty.tok2ind)
+
+    def test_hash_table(self):
+        """Are all tokens found when their slots collide, and after
+        pickling?
+        """
+        tokens = ['w{}'.format(i) for i in range(3000)]
+        frozen = FrozenDictionary(tokens, list(range(3000)))
+        self.assertEqual(len(frozen.table), 8192)
+        self.assertEqual([frozen.tok2ind[tok] for tok in tokens],
+                         list(range(3000)))
+        self.assertNotIn('w3000', frozen.tok2ind)
+        self.check(pickle.loads(pickle.dumps(
+            FrozenDictionary(self.tokens, self.freqs))))
+
+    def test_save_load(self):
+        """Is the dictionary memory-mapped back from disk?"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'dict')
+            FrozenDictionary(self.tokens, self.freqs).save(path)
+            self.check(FrozenDictionary.load(path))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_processes(self):
+        """Do other processes read the same dictionary?"""
+        frozen = FrozenDictionary(self.tokens, self.freqs)
+        found = Value('i', -1)
+
+        def lookup():
+            found.value = frozen.tok2ind['zebra'] + frozen.freq['the']
+
+        p = Process(target=lookup)
+        p.start()
+        p.join()
+        self.assertEqual(found.value, 6 + 5)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,165 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.core.fbdialog_teacher import FbDialogTeacher
+from parlai.core.params import ParlaiParser
+from parlai.core.worlds import create_task
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+try:
+    import torch
+    from parlai.agents.drqa.agents import SimpleDictionaryAgent
+    from parlai.agents.drqa.agents import DocReaderAgent
+    from parlai.agents.drqa.utils import build_feature_dict, vectorize
+except ImportError:
+    torch = None
+
+FBDIALOG = """1 Sam went to the kitchen.
+2 Pat gave Sam the milk.
+3 Where is the milk?\tkitchen
+4 Sam went to the hallway.
+5 Where is Sam?\thallway
+1 Pat went to the bathroom.
+2 Where is Pat?\tbathroom
+"""
+
+
+@unittest.skipIf(torch is None, 'DrQA needs pytorch')
+class TestDrQA(unittest.TestCase):
+    """Smoke tests of DrQA training, on a small fbdialog file."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, 'data.txt')
+        with open(self.datafile, 'w') as write:
+            write.write(FBDIALOG)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _opt(self, *args):
+        argparser = ParlaiParser()
+        SimpleDictionaryAgent.add_cmdline_args(argparser)
+        DocReaderAgent.add_cmdline_args(argparser)
+        opt = argparser.parse_args([
+            '-t', 'parlai.core.fbdialog_teacher:FbDialogTeacher',
+            '--datafile', self.datafile, '--no_cuda', 'True',
+            '--embedding_dim', '8', '--hidden_size', '8', '--doc_layers', '1',
+            '--question_layers', '1',
+        ] + list(args), print_args=False)
+        opt['cuda'] = False
+        return opt
+
+    def _train_and_validate(self, opt):
+        """Train for a few parleys, then run validation like
+        examples/drqa/train.py does, and return the validation report.
+        """
+        dictionary = SimpleDictionaryAgent(opt)
+        teacher = FbDialogTeacher(dict(opt, datatype='train:ordered'))
+        while not teacher.epoch_done():
+            dictionary.observe(teacher.act())
+            dictionary.act()
+        doc_reader = DocReaderAgent(opt, word_dict=dictionary)
+
+        train_world = create_task(dict(opt, datatype='train'), doc_reader)
+        try:
+            for _ in range(4):
+                train_world.parley()
+            train_world.synchronize()
+
+            with create_task(dict(opt, datatype='valid'),
+                             doc_reader) as valid_world:
+                for _ in valid_world:
+                    valid_world.parley()
+                return valid_world.report()
+        finally:
+            train_world.shutdown()
+
+    def test_hogwild(self):
+        """Can Hogwild training be followed by validation? With numthreads >
+        1, validation runs in a BatchWorld (batchsize > 1), in one process, or
+        in a ParallelEvalWorld (--parallel-eval).
+        """
+        for args in [['-bs', '1'], ['-bs', '1', '--parallel-eval', 'True'],
+                     ['-bs', '2']]:
+            opt = self._opt('--numthreads', '2', *args)
+            report = self._train_and_validate(opt)
+            self.assertEqual(report['total'], 3)
+            self.assertIn('f1', report)
+
+    def test_features(self):
+        """Do the in_question and tf features match the words, including the
+        ones outside the dictionary?
+        """
+        opt = self._opt()
+        dictionary = SimpleDictionaryAgent(opt)
+        dictionary.add_to_dict(['Sam', 'went', 'to', 'the', 'kitchen'])
+        feature_dict = build_feature_dict(opt)
+        ex = {
+            'document': ['Sam', 'went', 'to', 'The', 'kitchen', 'Zz', 'zz'],
+            'question': ['where', 'did', 'sam', 'go', 'the', 'Zz'],
+            'target': None,
+        }
+        _, features, _ = vectorize(opt, ex, dictionary, feature_dict)
+        self.assertEqual(features[:, feature_dict['in_question']].tolist(),
+                         [0, 0, 0, 0, 0, 1, 0])
+        self.assertEqual(
+            features[:, feature_dict['in_question_uncased']].tolist(),
+            [1, 0, 0, 1, 0, 1, 1])
+        tf = features[:, feature_dict['tf']] * 7
+        self.assertEqual([round(x) for x in tf.tolist()],
+                         [1, 1, 1, 1, 1, 2, 2])
+
+    def test_dictionary_cache(self):
+        """Does the DrQA dictionary tokenize through the cache, and still
+        pickle (it is saved with the model)?
+        """
+        dictionary = SimpleDictionaryAgent(self._opt('--dict-cache-size', '4'))
+        for _ in range(2):
+            self.assertEqual(dictionary.tokenize('Where is Sam?'),
+                             ['Where', 'is', 'Sam', '?'])
+        self.assertEqual(dictionary.tokenize_cache_info(),
+                         {'hits': 1, 'misses': 1, 'size': 1})
+        copy = pickle.loads(pickle.dumps(dictionary))
+        self.assertEqual(copy.tokenize('Where is Sam?'),
+                         ['Where', 'is', 'Sam', '?'])
+
+    def test_shared_dictionary(self):
+        """Do the copies of the agent share a frozen copy of its dictionary?
+        """
+        opt = self._opt()
+        dictionary = SimpleDictionaryAgent(opt)
+        dictionary.add_to_dict(['Sam', 'went', 'to', 'the', 'kitchen'])
+        doc_reader = DocReaderAgent(opt, word_dict=dictionary)
+        word_dict = doc_reader.share()['word_dict']
+        self.assertTrue(word_dict.frozen_is_used())
+        self.assertFalse(dictionary.frozen_is_used())
+        self.assertEqual(word_dict['kitchen'], dictionary['kitchen'])
+        self.assertEqual(word_dict.tokenize('Where is Sam?'),
+                         ['Where', 'is', 'Sam', '?'])
+        self.assertIs(doc_reader.share()['word_dict'], word_dict)
+
+    def test_dictionary_sketch(self):
+        """Does the DrQA dictionary count new tokens in the sketch?"""
+        dictionary = SimpleDictionaryAgent(self._opt(
+            '--dict-sketch-width', '64', '--dict-minfreq', '2'))
+        dictionary.add_to_dict(['milk', 'Sam', 'milk'])
+        dictionary.add_to_dict(['Sam'])
+        self.assertEqual(dictionary.sketch.table.sum(),
+                         4 * dictionary.sketch.depth)
+        self.assertEqual(dictionary.freq['milk'], 2)
+        self.assertEqual(dictionary.freq['Sam'], 2)
+        dictionary.add_to_dict(['kitchen'])
+        self.assertNotIn('kitchen', dictionary)
+        self.assertEqual([tok for tok, _ in dictionary.sort()],
+                         ['<NULL>', '<UNK>', 'Sam', 'milk'])
+
+
+if __name__ == '__main__':
+    unittest.main()
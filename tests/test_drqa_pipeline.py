@@ -0,0 +1,104 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.agents.drqa.pipeline import TrainPipeline
+import threading
+import time
+import unittest
+
+
+class Recorder(object):
+    """Builds batches of observations as they are, and records updates."""
+
+    def __init__(self, delays=None, fail=None):
+        self.delays = delays or {}
+        self.fail = fail
+        self.updates = []
+
+    def build(self, observations):
+        time.sleep(self.delays.get(observations[0], 0))
+        if observations[0] == self.fail:
+            raise ValueError('cannot build {}'.format(observations[0]))
+        return list(observations), 'batch'
+
+    def update(self, examples, batch):
+        self.updates.append((examples, batch))
+
+
+class TestTrainPipeline(unittest.TestCase):
+    """Checks on the DrQA training pipeline (no torch needed)."""
+
+    def test_bucketing(self):
+        """Does every observed example reach update, in length buckets?"""
+        recorder = Recorder()
+        pipeline = TrainPipeline(recorder.build, recorder.update, batchsize=2,
+                                 bucket_pool=2)
+        examples = ['aaaa', 'b', 'ccc', 'dd', 'eeeee', 'f', 'ggg']
+        for i in range(0, len(examples), 2):
+            pipeline.submit(examples[i:i + 2])
+        # the first four examples filled the pool and were trained on
+        self.assertEqual(sorted(ex for batch, _ in recorder.updates
+                                for ex in batch),
+                         ['aaaa', 'b', 'ccc', 'dd'])
+        self.assertIn((['b', 'dd'], None), recorder.updates)
+        pipeline.shutdown()
+        trained = [ex for batch, _ in recorder.updates for ex in batch]
+        self.assertEqual(sorted(trained), sorted(examples))
+        self.assertIn((['f', 'ggg'], None), recorder.updates)
+
+    def test_prefetch_order(self):
+        """Are prefetched batches trained on in the order they came?"""
+        # the first batches take longest to build
+        recorder = Recorder(delays={0: 0.05, 1: 0.02})
+        pipeline = TrainPipeline(recorder.build, recorder.update, batchsize=1,
+                                 workers=3, depth=2)
+        for i in range(6):
+            pipeline.submit([i])
+        self.assertTrue(len(pipeline.pending) <= 2)
+        pipeline.drain()
+        self.assertEqual([batch for batch, _ in recorder.updates],
+                         [[i] for i in range(6)])
+        self.assertEqual(pipeline.map(lambda x: x * 2, [1, 2]), [2, 4])
+        pipeline.shutdown()
+        self.assertIsNone(pipeline.executor)
+
+    def test_lazy_threads(self):
+        """Are the worker threads only started when a batch is built?"""
+        threads = threading.active_count()
+        recorder = Recorder()
+        pipeline = TrainPipeline(recorder.build, recorder.update, batchsize=1,
+                                 workers=2)
+        self.assertIsNone(pipeline.executor)
+        self.assertEqual(threading.active_count(), threads)
+        pipeline.shutdown()
+        self.assertEqual(recorder.updates, [])
+
+    def test_errors(self):
+        """Are errors raised while building batches passed on, in order?"""
+        recorder = Recorder(delays={1: 0.05}, fail=1)
+        pipeline = TrainPipeline(recorder.build, recorder.update, batchsize=1,
+                                 workers=2, depth=2)
+        pipeline.submit([0])
+        pipeline.submit([1])
+        with self.assertRaises(ValueError):
+            pipeline.drain()
+        self.assertEqual([batch for batch, _ in recorder.updates], [[0]])
+
+        # a failed batch is raised by the next submit once it is the oldest
+        pipeline.submit([1])
+        time.sleep(0.1)
+        with self.assertRaises(ValueError):
+            pipeline.submit([2])
+        pipeline.shutdown()
+        self.assertEqual([batch for batch, _ in recorder.updates], [[0], [2]])
+
+        # without workers, errors are raised by submit itself
+        pipeline = TrainPipeline(recorder.build, recorder.update, batchsize=1)
+        with self.assertRaises(ValueError):
+            pipeline.submit([1])
+
+
+if __name__ == '__main__':
+    unittest.main()
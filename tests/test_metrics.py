@@ -0,0 +1,83 @@
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+from parlai.core.metrics import Metrics
+from multiprocessing import Process
+import unittest
+
+EXAMPLES = [
+    ({'text': 'the Kitchen'}, ['kitchen'], None),
+    ({'text': 'hallway'}, ['kitchen', 'bathroom'], None),
+    ({'text': 'a milk bottle!'}, ['the milk', 'bottle'], None),
+    ({'text': 'b', 'text_candidates': ['b', 'a', 'c']}, ['a'], None),
+    ({}, ['a'], None),
+]
+
+
+class TestMetrics(unittest.TestCase):
+    """Checks on the metrics shared by all teachers."""
+
+    def test_shared_report(self):
+        """Do metrics shared between processes report the same values as
+        metrics updated in a single process?
+        """
+        local = Metrics({})
+        for obs, labels, cands in EXAMPLES * 4:
+            local.update(obs, labels, cands)
+
+        shared = Metrics({'numthreads': 4})
+
+        def update():
+            for obs, labels, cands in EXAMPLES:
+                shared.update(obs, labels, cands)
+
+        threads = [Process(target=update) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        shared_report = shared.report()
+        local_report = local.report()
+        # f1 sums are only equal up to the order of float additions
+        self.assertAlmostEqual(shared_report.pop('f1'), local_report.pop('f1'))
+        self.assertEqual(shared_report, local_report)
+
+        shared.clear()
+        self.assertEqual(shared.report()['total'], 0)
+
+    def test_batch_update(self):
+        """Does scoring a batch at once match scoring one at a time?"""
+        single = Metrics({})
+        losses = [single.update(obs, labels, cands)
+                  for obs, labels, cands in EXAMPLES]
+        batch = Metrics({})
+        observations, labels_list, cands_list = zip(*EXAMPLES)
+        self.assertEqual(
+            batch.batch_update(observations, labels_list, cands_list), losses)
+        self.assertEqual(batch.report(), single.report())
+        self.assertEqual(losses[0], {'correct': 1})
+
+    def test_label_cache(self):
+        """Are labels normalized once and the cache counters reported?"""
+        metrics = Metrics({'metrics_cache_size': 2,
+                           'metrics_cache_report': True})
+        for _ in range(3):
+            metrics.update({'text': 'the milk'}, ['milk'], None)
+        self.assertEqual(metrics.report()['label_cache'],
+                         {'hits': 2, 'misses': 1, 'size': 1})
+        metrics.update({'text': 'milk'}, ['a', 'b', 'c'], None)
+        self.assertEqual(metrics.report()['label_cache']['size'], 2)
+
+        self.assertNotIn('label_cache',
+                         Metrics({'metrics_cache_size': 2}).report())
+        uncached = Metrics({'metrics_cache_size': 0,
+                            'metrics_cache_report': True})
+        uncached.update({'text': 'the milk'}, ['milk'], None)
+        self.assertNotIn('label_cache', uncached.report())
+        self.assertEqual(uncached.report()['accuracy'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
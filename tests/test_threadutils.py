@@ -3,7 +3,7 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
-from parlai.core.thread_utils import SharedTable
+from parlai.core.thread_utils import SharedTable, SharedCounters
 from multiprocessing import Process
 import unittest
 import random
@@ -79,5 +79,79 @@ class TestSharedTable(unittest.TestCase):
         assert st['cnt'] == 250
 
 
+class TestSharedCounters(unittest.TestCase):
+    """Make sure per-process counters add up without locking."""
+
+    def test_single_process(self):
+        cnts = SharedCounters(['cnt', 'f1'], num_procs=1)
+        cnts.add('cnt', 1)
+        cnts.add('cnt', 2)
+        cnts.add('f1', 0.5)
+        assert cnts['cnt'] == 3
+        assert cnts.totals() == {'cnt': 3, 'f1': 0.5}
+        cnts.clear()
+        assert cnts['cnt'] == 0
+
+    def test_concurrent_add(self):
+        cnts = SharedCounters(['cnt'], num_procs=5)
+
+        def inc():
+            for _ in range(50):
+                cnts.add('cnt', 1)
+
+        threads = []
+        for _ in range(5):  # numthreads
+            threads.append(Process(target=inc))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert cnts['cnt'] == 250
+
+        # the rows of released processes are taken over, keeping their counts
+        SharedCounters.release_process(threads[0].pid)
+        cnts.add('cnt', 1)
+        assert cnts['cnt'] == 251
+
+    def test_reuse_rows(self):
+        cnts = SharedCounters(['cnt'], num_procs=2)
+
+        def inc():
+            cnts.add('cnt', 1)
+
+        # more processes than rows, each one exiting before the next starts
+        for _ in range(4):
+            p = Process(target=inc)
+            p.start()
+            p.join()
+            assert p.exitcode == 0
+            SharedCounters.release_process(p.pid)
+        assert cnts['cnt'] == 4
+
+        # rows are only freed by release, not when their process exits
+        cnts = SharedCounters(['cnt'], num_procs=1)
+        p = Process(target=inc)
+        p.start()
+        p.join()
+        try:
+            cnts.add('cnt', 1)
+            assert False, 'took over the row of an unreleased process'
+        except RuntimeError:
+            pass
+        SharedCounters.release_process(p.pid)
+        cnts.add('cnt', 1)
+        assert cnts['cnt'] == 2
+
+        # the only row belongs to a running process
+        cnts = SharedCounters(['cnt'], num_procs=1)
+        cnts.add('cnt', 1)
+        try:
+            cnts._pid = None
+            cnts.add('cnt', 1)
+            assert False, 'did not fail when out of rows'
+        except RuntimeError:
+            pass
+
+
 if __name__ == '__main__':
     unittest.main()